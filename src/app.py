@@ -3,11 +3,12 @@
 # ----------------------------------------------------------------------------
 # Dash Framework
 import dash_bootstrap_components as dbc
-from dash import Dash, callback, clientside_callback, html, dcc, dash_table as dt, Input, Output, State, MATCH, ALL
+from dash import Dash, callback, clientside_callback, html, dcc, dash_table as dt, Input, Output, State, MATCH, ALL, no_update
 from dash.exceptions import PreventUpdate
 import dash_daq as daq
 
 import plotly.figure_factory as ff
+from dateutil.relativedelta import relativedelta
 
 # import local modules
 from config_settings import *
@@ -54,8 +55,6 @@ scan_dict = {
 icols = list(scan_dict.keys())
 icols2 = list(scan_dict.values())
 
-color_mapping_list = [(0.0, 'white'),(0.1, 'lightgrey'),(0.25, 'red'),(0.5, 'orange'),(0.75, 'yellow'),(1.0, 'green')]
-
 # ----------------------------------------------------------------------------
 # APP Settings
 # ----------------------------------------------------------------------------
@@ -116,10 +115,10 @@ def overview_heatmap(imaging):
 
     other_cols = ['site', 'subject_id', 'visit']
     i2 = pd.melt(imaging[other_cols + icols], id_vars=other_cols, value_vars = icols)
-    hm = i2.groupby(['site','variable'])['value'].sum().reset_index()
+    hm = i2.groupby(['site','variable'], observed=True)['value'].sum().reset_index()
 
-    subjects = imaging[['subject_id','visit','site']].groupby(['site']).count().reset_index()
-    subjects['Site'] = subjects['site'] + ' [' + subjects['visit'].astype('str') + ']'
+    subjects = imaging[['subject_id','visit','site']].groupby(['site'], observed=True).count().reset_index()
+    subjects['Site'] = subjects['site'].astype('str') + ' [' + subjects['visit'].astype('str') + ']'
 
     figdf = hm.merge(subjects, how='left', on='site')
     figdf['normed'] = 100 * figdf['value']/figdf['subject_id']
@@ -170,7 +169,7 @@ def create_image_overview(imaging_overview):
     ])
     return overview_div
 
-def completions_div(completions_cols, completions_data, imaging):
+def completions_div(completions_cols, completions_data, heatmap_fig):
     completions_div = [
         dbc.Row([dbc.Col([
             html.H3('Percent of imaged subjects completing a particular scan by site')
@@ -178,7 +177,7 @@ def completions_div(completions_cols, completions_data, imaging):
         dbc.Row([
             dbc.Col([
                 # html.Div(overview_heatmap(imaging))
-                dcc.Graph(id='graph-overview-heatmap', figure = overview_heatmap(imaging))
+                dcc.Graph(id='graph-overview-heatmap', figure = heatmap_fig)
             ]),
         ]),
         dbc.Row([dbc.Col([
@@ -201,17 +200,22 @@ def completions_div(completions_cols, completions_data, imaging):
     return completions_div
 
 
-def build_boxplot(df):
+def build_boxplot(cuff_stats):
     fig=go.Figure()
 
-    data_length = (len(df['site'].unique()))
-
-    for i, visit in enumerate(df['visit'].unique()):
-        df_plot=df[df['visit']==visit]
-        #print(df_plot.head())
+    # Boxes are drawn from the statistics of each site and visit, with only the outliers as points
+    visits = cuff_stats['visit'].unique()
+    for i, visit in enumerate(visits):
+        df_plot = cuff_stats[(cuff_stats['visit']==visit) & (cuff_stats['values'] > 0)]
 
         fig.add_trace(go.Box(x=df_plot['site'],
-                             y=df_plot['Cuff1 Applied Pressure'],
+                             q1=df_plot['q1'],
+                             median=df_plot['median'],
+                             q3=df_plot['q3'],
+                             lowerfence=df_plot['lowerfence'],
+                             upperfence=df_plot['upperfence'],
+                             y=list(df_plot['outliers']),
+                             orientation='v',
                              meta = visit,
 #                              boxmean="sd",
                              line=dict(color=px.colors.qualitative.Plotly[i]),
@@ -222,32 +226,28 @@ def build_boxplot(df):
 
 
         ## loop through the values you want to label and add them as annotations
-    for i, visit in enumerate(df['visit'].unique()):
-        for s in df['site'].unique():
+    for i, visit in enumerate(visits):
+        for row in cuff_stats[cuff_stats['visit']==visit].itertuples():
             # Get settings for annotation
             xshift = 25
             if i == 0:
                 xshift = -xshift
             else:
                 xshift = xshift
-            y_point = df[(df['site']==s) & (df['visit']==visit)]['Cuff1 Applied Pressure'].median()
-            records = len(df[(df['site']==s) & (df['visit']==visit)]['Cuff1 Applied Pressure'])
-            if records > 0:
-                text = '<b>' + str(len(df[(df['site']==s) & (df['visit']==visit)]['Cuff1 Applied Pressure'])) + '</b>'
-
-            else:
-                text =''
 
             fig.add_annotation(
-                    x=s,
-                    y=y_point,
-                    text=text,
+                    x=row.site,
+                    y=row.median,
+                    text='<b>' + str(row.records) + '</b>',
                     showarrow=False,
                     xshift = xshift,
                     yshift=10,
 
             )
 
+    # Sites in the order their records first appear, including sites without pressure values
+    sites = pd.concat([cuff_stats[cuff_stats['visit']==visit]['site'] for visit in visits]).unique()
+    fig.update_xaxes(categoryorder='array', categoryarray=list(sites))
     fig.update_layout(boxmode='group',
                       xaxis_tickangle=0,
         autosize=False,
@@ -256,70 +256,142 @@ def build_boxplot(df):
                 orientation="h"))
 
     return fig
-# ----------------------------------------------------------------------------
-# DASH APP LAYOUT FUNCTION
-# ----------------------------------------------------------------------------
-def load_data_source(url_data_path, local_data_path, source):
-    imaging, imaging_source = load_imaging(url_data_path, local_data_path, source)
-    qc, qc_source = load_qc(url_data_path, local_data_path, source)
-
-    return imaging, imaging_source, qc, qc_source
-
-def get_filtered_data_store(raw_data_store, start_date: datetime = None, end_date = None):
-    imaging = pd.DataFrame.from_dict(raw_data_store['imaging'])
-    qc = pd.DataFrame.from_dict(raw_data_store['qc'])
-
-    if imaging.empty or qc.empty:
-        completions = pd.DataFrame()
-        imaging_overview =  pd.DataFrame()
-        indicated_received =  pd.DataFrame()
-        stacked_bar_df =  pd.DataFrame()
-        sites = []
+
+# The cuff pressure statistics and boxplot are built once per table set, like the report tables
+derived_table('cuff_stats', 'imaging')(lambda imaging: get_box_stats(imaging, 'Cuff1 Applied Pressure', ['visit', 'site']))
+derived_table('cuff_figure', 'cuff_stats', empty=go.Figure, figure=True)(build_boxplot)
+
+@derived_table('rescinded_imaging', 'imaging')
+def get_rescinded_imaging(imaging):
+    cols = ['site', 'subject_id', 'visit',  'dicom',
+      'bids', 'bids_validation', 'acquisition_week', 'Surgery Week']
+    return imaging[imaging['subject_id'].isin(list(rescinded['main_record_id']))][cols]
+
+# Completions tab: the completions table columns and records for all sites, and the scan heatmap
+# The session counts of the report window come from the date index
+@derived_table('completions_table', 'sites', 'date_index', 'date_window')
+def build_completions_table(sites, date_index, window):
+    sites_list = ['ALL', 'MCC1', 'MCC2'] + sites
+    completions = merge_completion_counts(sites_list, get_window_completion_counts(date_index, window), sites_info)
+
+    # Conver tuples to multiindex then prepare data for dash data table
+    completions.columns = pd.MultiIndex.from_tuples(completions.columns)
+    return datatable_settings_multiindex(completions)
+
+derived_table('overview_heatmap', 'imaging', empty=go.Figure, figure=True)(overview_heatmap)
+
+# Quality ratings stacked bar chart for each chart type ('Count' or 'Percent'), visit toggle and chart
+# selection. All combinations are built when a snapshot is published, so the toggles never wait on them.
+# Counts of qc ratings by site, mcc, visit, scan and rating, which every bar chart is summed from
+derived_table('qc_counts', 'qc')(lambda qc: get_count_cube(qc, mcc_dict))
+
+@derived_table('stacked_bar', 'qc_counts', empty=go.Figure, figure=True)
+def build_stackedbar(qc_counts, chart_type, visit, chart_selection):
+    if qc_counts.empty:
+        # A date window without qc ratings; update_stackedbar shows a message instead
+        return go.Figure()
+    count_col='sub'
+    color_col = 'rating'
+
+    if chart_selection == 1:
+        if visit:
+            facet_row = 'ses'
+        else:
+            facet_row = None
+        fig = bar_chart_cube(qc_counts, count_col, 'site', color_col, 'mcc', facet_row,  chart_type=chart_type)
     else:
-        imaging = filter_imaging(imaging, start_date = start_date, end_date = end_date)
-        qc = filter_qc(qc, imaging)
+        if visit:
+            x_col = 'ses'
+        else:
+            x_col = None
+        if chart_selection == 2:
+            fig = bar_chart_cube(qc_counts, count_col, x_col, color_col, 'site', chart_type=chart_type)
 
-        completions = get_completions(imaging)
-        imaging_overview = roll_up(imaging)
-        indicated_received = get_indicated_received(imaging)
-        ratings = indicated_received.merge(qc, how='outer', left_on = ['Site','Subject','Visit','Scan'], right_on=['site','sub','ses','scan']).fillna('N/A')
+        elif chart_selection == 3:
+            fig = bar_chart_cube(qc_counts, count_col, x_col, color_col, 'mcc', chart_type=chart_type)
 
-        stacked_bar_df = get_stacked_bar_data(qc, 'sub', 'rating', ['site','ses'])
-        sites = list(imaging.site.unique())
+        else:
+            fig = bar_chart_cube(qc_counts, count_col, x_col, color_col, chart_type=chart_type)
+    return fig
 
-    processed_data_dictionary = {
-        'imaging': imaging.to_dict('records'),
-        'qc': qc.to_dict('records'),
-        'sites': sites,
-        'completions': completions.to_dict('records'),
-        'imaging_overview' : imaging_overview.to_dict('records'),
-        'ratings' : ratings.to_dict('records'),
-        'indicated_received' : indicated_received.to_dict('records'),
-    }
+snapshot_warm_tables.extend(('stacked_bar', chart_type, visit, chart_selection)
+                            for chart_type in ['Count', 'Percent'] for visit in [False, True] for chart_selection in [1, 2, 3, 4])
+
+# Heat Map tab: each site's heat matrix is shown a page of subjects at a time, under a strip of its
+# mean ratings by week, so the figures stay the same size as sites enroll more subjects. The figures
+# are None for a site without qc ratings. The strips and first pages of the dropdown sites are built
+# with each snapshot.
+HEATMAP_PAGE_SIZE = 50
+
+@derived_table('heatmap_figure', 'heat_matrices', empty=lambda: None, figure=True)
+def build_heatmap_figure(heat_matrices, site, page=0):
+    if site not in heat_matrices:
+        return None
+    matrix = heat_matrices[site].iloc[page * HEATMAP_PAGE_SIZE:(page + 1) * HEATMAP_PAGE_SIZE]
+    return generate_heat_matrix(matrix, color_mapping_list)
+
+@derived_table('heatmap_strip', 'heat_strips', empty=lambda: None, figure=True)
+def build_heatmap_strip(heat_strips, site):
+    if site not in heat_strips:
+        return None
+    return generate_heat_strip(heat_strips[site], color_mapping_list)
+
+snapshot_warm_tables.extend(table for site in mcc_dict['site'] for table in [('heatmap_figure', site, 0), ('heatmap_strip', site)])
+
+# Pie charts of the selected sites, from the BIDS sums by site, scan and rating
+@derived_table('pie_chart', 'rating_counts', empty=go.Figure, figure=True)
+def build_pie_chart(rating_counts, sites, facet_row=None):
+    sites_list = sites.split(",")
+    fig = make_pie_chart(rating_counts[rating_counts['Site'].isin(sites_list)], facet_row=facet_row)
+    if facet_row:
+        fig_height = len(sites_list) * 300
+        fig.update_layout(
+            autosize=False,
+            width =1500,
+            height=fig_height)
+    return fig
+
+# Discrepancy tables, which are paged, filtered and sorted on the server
+discrepancy_tables = {'tbl-no_bids': 'no_bids', 'tbl-mismatch': 'mismatch', 'tbl-rescinded': 'rescinded_imaging'}
+DISCREPANCY_PAGE_SIZE = 25
+
+def discrepancy_table(table_id, df):
+    '''Return the first page of df in a DataTable, with a message area below it for filter errors'''
+    data, page_count, page_current = get_table_page(df, 0, DISCREPANCY_PAGE_SIZE)
+    return html.Div([
+            dt.DataTable(
+                id=table_id, data=data,
+                columns=[{"name": i, "id": i} for i in df.columns],
+                page_action="custom",
+                page_current=0,
+                page_size=DISCREPANCY_PAGE_SIZE,
+                page_count=page_count,
+                filter_action="custom",
+                filter_query='',
+                sort_action="custom",
+                sort_mode="multi",
+                sort_by=[],
+                ),
+            html.Div(id=table_id + '-message'),
+            ])
 
-    return processed_data_dictionary
+# ----------------------------------------------------------------------------
+# DASH APP LAYOUT FUNCTION
+# ----------------------------------------------------------------------------
+def get_data_table(data, name, *params):
+    '''Return a report table for the filtered_data store, which only holds the snapshot version and
+    filter dates. The tables are shared with other callbacks and must not be modified.'''
+    return get_table(get_store_tables(data, data_url_root, DATA_PATH, DATA_SOURCE), name, *params)
 
 def serve_raw_data_store(url_data_path, local_data_path, source):
-    imaging, imaging_source, qc, qc_source = load_data_source(url_data_path, local_data_path, source)
-
-    if imaging.empty or qc.empty:
-        # completions = pd.DataFrame()
-        # imaging_overview =  pd.DataFrame()
-        # indicated_received =  pd.DataFrame()
-        # stacked_bar_df =  pd.DataFrame()
-        sites = []
-    else:
-        # completions = get_completions(imaging)
-        # imaging_overview = roll_up(imaging)
-        # indicated_received = get_indicated_received(imaging)
-        # stacked_bar_df = get_stacked_bar_data(qc, 'sub', 'rating', ['site','ses'])
-        sites = list(imaging.site.unique())
+    snapshot = get_data_snapshot(url_data_path, local_data_path, source)
+    sites = snapshot['sites']
 
+    # The data itself stays on the server; see get_data_table
     raw_data_dictionary = {
-        'imaging': imaging.to_dict('records'),
-        'qc': qc.to_dict('records'),
-        'imaging_source': imaging_source,
-        'qc_source': qc_source,
+        'version': snapshot['version'],
+        'snapshot_status': snapshot['status'],
+        'snapshot_refreshed': snapshot['refreshed'],
         'sites': sites,
         # 'completions': completions.to_dict('records'),
         # 'imaging_overview' : imaging_overview.to_dict('records'),
@@ -331,17 +403,17 @@ def serve_raw_data_store(url_data_path, local_data_path, source):
         dcc.Store(id='filtered_data'),
         # html.P('Imaging Source: ' + data_dictionary['imaging_source']),
         # html.P('QC Source: ' + data_dictionary['qc_source']),
-        create_content(source, sites)
+        create_content(source, sites, snapshot)
     ])
     return data_stores
 
 
 
-def create_content(source, sites):
+def create_content(source, sites, snapshot):
     if source == 'local':
         source_msg = 'Data loaded from local files dated ' + LOCAL_DATA_DATE
     else:
-        source_msg = 'Data from API'
+        source_msg = 'Data from API, ' + describe_snapshot(snapshot)
     if len(sites) > 0:
         content = html.Div([
                     html.Div([
@@ -357,7 +429,22 @@ def create_content(source, sites):
                                 html.P(version_msg),
                                 html.P(source_msg)
                                 ],
-                            width=10),
+                            width=6),
+                            dbc.Col([
+                                html.P('Add dates to limit report range '),
+                                dcc.DatePickerRange(
+                                    id='report-date-picker-range',
+                                    initial_visible_month = date.today() + relativedelta(months=-2),
+                                    min_date_allowed = '2021-03-29',
+                                    number_of_months_shown = 3,
+                                    show_outside_days = True,
+                                    clearable = True,
+                                ),
+                                html.Div(id='report-date-message'),
+                            ], width=3),
+                            dbc.Col([
+                                html.Br(),
+                                dbc.Button('Rerun Report', id='btn-rerun-dates',n_clicks=0),],width=1),
                             dbc.Col([
                                 # offcanvas
                                 html.Div([
@@ -415,6 +502,10 @@ def create_content(source, sites):
                     , style={'border':'1px solid black', 'padding':'10px'}
                 )
             ])
+    elif snapshot['status'] == 'loading':
+        content = html.Div([
+            dbc.Alert("The data for this report is still loading. Please refresh the page in a moment.", color="info")
+        ])
     else:
         content = html.Div([
             dbc.Alert("There has been a problem accessing the data API. Please try again in a few minutes.", color="warning")
@@ -436,6 +527,14 @@ def serve_layout():
 
 app.layout = serve_layout
 
+# Load the first data snapshot while the app is imported, so gunicorn --preload workers start
+# with data, then keep it fresh from a background thread in each worker process
+initialize_data_snapshot(data_url_root, DATA_PATH, DATA_SOURCE)
+
+@app.server.before_request
+def ensure_data_refresher():
+    start_data_refresher(data_url_root, DATA_PATH, DATA_SOURCE)
+
 
 # ----------------------------------------------------------------------------
 # DATA CALLBACKS
@@ -443,11 +542,21 @@ app.layout = serve_layout
 # Filter
 @app.callback(
     Output('filtered_data', 'data'),
-    Input('session_data', 'data')
+    Output('report-date-message', 'children'),
+    Input('session_data', 'data'),
+    Input('btn-rerun-dates', 'n_clicks'),
+    State('report-date-picker-range', 'start_date'),
+    State('report-date-picker-range', 'end_date')
 )
-def filtered(raw_data):
-    filtered_data = get_filtered_data_store(raw_data)
-    return filtered_data
+def filtered(raw_data, n_clicks, start_date, end_date):
+    # The unfiltered tables are built with the snapshot by the background refresher; the tables of
+    # a report window are built from them when a tab asks for them (see get_store_tables)
+    snapshot = get_data_snapshot(data_url_root, DATA_PATH, DATA_SOURCE, raw_data['version'])
+    store = get_filtered_store(snapshot, start_date or None, end_date or None)
+    if (start_date or end_date) and get_data_table(store, 'imaging').empty:
+        # Dates without imaging records leave the report as it is, and say so
+        return no_update, dbc.Alert("There are no imaging records between these dates. The report still shows the previous dates.", color="warning")
+    return store, None
 
 # Filter
 @app.callback(
@@ -576,7 +685,7 @@ def switch_tab(at):
     Input('filtered_data', 'data')
 )
 def update_overview_section(data):
-    imaging_overview = pd.DataFrame.from_dict(data['imaging_overview'])
+    imaging_overview = get_data_table(data, 'imaging_overview')
     return create_image_overview(imaging_overview)
 
 @app.callback(
@@ -584,72 +693,58 @@ def update_overview_section(data):
     Input('filtered_data', 'data')
 )
 def update_discrepancies_section(data):
-    # Load imaging data from data store
-     imaging = pd.DataFrame.from_dict(data['imaging'])
-     df = pd.DataFrame.from_dict(data['indicated_received'])
-
      # Rescinded patients in imaging
-     cols = ['site', 'subject_id', 'visit',  'dicom',
-       'bids', 'bids_validation', 'acquisition_week', 'Surgery Week']
-     rescinded_imaging = imaging[imaging['subject_id'].isin(list(rescinded['main_record_id']))][cols]
      rescind_msg = 'Subjects who rescinded prior to ' + rescinded_date + ' but have records in the imaging file'
 
-     # Get data for tables
-     # df = get_indicated_received(imaging)
-     df = pd.DataFrame.from_dict(data['indicated_received'])
-     index_cols = ['Site','Subject','Visit']
-     no_bids = df[df['BIDS']==0].sort_values(by=index_cols+['Scan'])
-     mismatch = df[(df['DICOM']==1) & (df['Indicated'] != df['Received'])]
-
-     no_bids_table = dt.DataTable(
-                    id='tbl-no_bids', data=no_bids.to_dict('records'),
-                    columns=[{"name": i, "id": i} for i in no_bids.columns],
-                    filter_action="native",
-                    sort_action="native",
-                    sort_mode="multi",
-                    )
-
-     mismatch_table = dt.DataTable(
-                    id='tbl-mismatch', data=mismatch.to_dict('records'),
-                    columns=[{"name": i, "id": i} for i in mismatch.columns],
-                    filter_action="native",
-                    sort_action="native",
-                    sort_mode="multi",
-                    )
-
-     rescinded_table = dt.DataTable(
-                    id='tbl-rescinded', data=rescinded_imaging.to_dict('records'),
-                    columns=[{"name": i, "id": i} for i in rescinded_imaging.columns],
-                    filter_action="native",
-                    sort_action="native",
-                    sort_mode="multi",
-                    )
-
-
+     # Only the first page of each table is sent; paging, filtering and sorting are done by update_discrepancy_table
      discrepancies_div = html.Div([
              dbc.Col([
                  html.H3("BIDS value = 0"),
-                 no_bids_table
+                 discrepancy_table('tbl-no_bids', get_data_table(data, 'no_bids'))
              ],width=6),
            dbc.Col([
                html.H3('Records with mismatch between indicated and received'),
-               mismatch_table
+               discrepancy_table('tbl-mismatch', get_data_table(data, 'mismatch'))
            ],width=6),
            dbc.Col([
                html.H3(rescind_msg),
-               rescinded_table
+               discrepancy_table('tbl-rescinded', get_data_table(data, 'rescinded_imaging'))
            ],width=6),
      ])
      return discrepancies_div
 
+def update_discrepancy_table(table_name):
+    def update_table(page_current, page_size, sort_by, filter_query, data):
+        df = get_data_table(data, table_name)
+        try:
+            records, page_count, page_current = get_table_page(df, page_current, page_size, sort_by, filter_query)
+            return records, page_count, page_current, None
+        except ValueError as e:
+            # A filter that cannot be applied matches no rows rather than being ignored
+            return [], 1, 0, dbc.Alert(str(e), color="warning")
+    return update_table
+
+for table_id, table_name in discrepancy_tables.items():
+    app.callback(
+        Output(table_id, 'data'),
+        Output(table_id, 'page_count'),
+        Output(table_id, 'page_current'),
+        Output(table_id + '-message', 'children'),
+        Input(table_id, 'page_current'),
+        Input(table_id, 'page_size'),
+        Input(table_id, 'sort_by'),
+        Input(table_id, 'filter_query'),
+        State('filtered_data', 'data'),
+        prevent_initial_call=True
+    )(update_discrepancy_table(table_name))
+
 @app.callback(
     Output('cuff_section', 'children'),
     Input('filtered_data', 'data')
 )
 def update_cuff_section(data):
     # Load imaging data from data store
-     imaging = pd.DataFrame.from_dict(data['imaging'])
-     fig = build_boxplot(imaging)
+     fig = get_data_table(data, 'cuff_figure')
      cuff_div = html.Div([
              dbc.Col([
                  html.H3("Cuff1 Applied Pressure"),
@@ -666,38 +761,17 @@ def update_cuff_section(data):
     Input('dropdown-bar', 'value'),
 )
 def update_stackedbar(filtered_data, type, visit, chart_selection):
-    global mcc_dict
     # False = Count and True = Percent
-    # return json.dumps(mcc_dict)
     if type:
         type = 'Percent'
     else:
         type = 'Count'
 
-    qc = pd.DataFrame.from_dict(filtered_data['qc'])
-    count_col='sub'
-    color_col = 'rating'
-
-    if chart_selection == 1:
-        if visit:
-            facet_row = 'ses'
-        else:
-            facet_row = None
-        fig = bar_chart_dataframe(qc, mcc_dict, count_col, 'site', color_col, 'mcc', facet_row,  chart_type=type)
-    else:
-        if visit:
-            x_col = 'ses'
-        else:
-            x_col = None
-        if chart_selection == 2:
-            fig = bar_chart_dataframe(qc, mcc_dict, count_col, x_col, color_col, 'site', chart_type=type)
-
-        elif chart_selection == 3:
-            fig = bar_chart_dataframe(qc, mcc_dict, count_col, x_col, color_col, 'mcc', chart_type=type)
-
-        else:
-            fig = bar_chart_dataframe(qc, mcc_dict, count_col, x_col, color_col, chart_type=type)
-
+    if get_data_table(filtered_data, 'qc_counts').empty:
+        return html.Div([
+            html.H4('There are no quality ratings for the selected dates')
+        ], style={'padding': '50px', 'font-style': 'italic'})
+    fig = get_data_table(filtered_data, 'stacked_bar', type, bool(visit), chart_selection)
     return [html.P(visit), dcc.Graph(id='graph_stackedbar', figure=fig)]
 
 @app.callback(
@@ -706,16 +780,8 @@ def update_stackedbar(filtered_data, type, visit, chart_selection):
     State('filtered_data', 'data')
 )
 def update_image_report(sites, data):
-    imaging = pd.DataFrame.from_dict(data['imaging'])
-    sites_list = ['ALL', 'MCC1', 'MCC2'] + list(imaging.site.unique())
-    completions = merge_completions(sites_list, imaging, sites_info)
-
-    # Conver tuples to multiindex then prepare data for dash data table
-    completions.columns = pd.MultiIndex.from_tuples(completions.columns)
-    completions_cols, completions_data = datatable_settings_multiindex(completions)
-    ct = completions_div(completions_cols, completions_data, imaging)
-    # kids = [html.P(c) for c in list(completions.columns)]
-    # return kids
+    completions_cols, completions_data = get_data_table(data, 'completions_table')
+    ct = completions_div(completions_cols, completions_data, get_data_table(data, 'overview_heatmap'))
     return ct
 
 @app.callback(
@@ -726,9 +792,7 @@ def update_image_report(sites, data):
 )
 def update_pie(sites, filtered_data, options):
     sites_list = sites.split(",")
-    ratings = pd.DataFrame.from_dict(filtered_data['ratings'])
     site_label = [x['label'] for x in options if x['value'] == sites]
-    pie_df = ratings[ratings['Site'].isin(sites_list)]
 
     pie_charts = [
         dbc.Row([dbc.Col([
@@ -736,21 +800,14 @@ def update_pie(sites, filtered_data, options):
         ])]),
         dbc.Row([
             html.H4(site_label),
-            dcc.Graph(id='pie_main', figure=make_pie_chart(pie_df))
+            dcc.Graph(id='pie_main', figure=get_data_table(filtered_data, 'pie_chart', sites))
         ])
     ]
 
     if len(sites_list) > 1:
-        fig_height = len(sites_list) * 300
-        fig=make_pie_chart(pie_df, facet_row='Site')
-        fig.update_layout(
-            autosize=False,
-            width =1500,
-            height=fig_height)
-
         add_div =dbc.Row([
             html.H4('Breakout by Site'),
-            dcc.Graph(id='pie_main', figure=fig)
+            dcc.Graph(id='pie_main', figure=get_data_table(filtered_data, 'pie_chart', sites, 'Site'))
         ])
         pie_charts.append(add_div)
 
@@ -761,18 +818,26 @@ def update_pie(sites, filtered_data, options):
 @app.callback(
     Output('heatmap', 'children'),
     Input('dropdown-sites', 'value'),
-    State('filtered_data', 'data')
+    Input('filtered_data', 'data')
 )
 def update_heatmap(sites, data):
-    global color_mapping_list
+    # The strip, page count and first page are rebuilt when the report dates change, so that every
+    # page shown by update_heatmap_page is of the same window
     sites_list = sites.split(",")
-    qc = pd.DataFrame.from_dict(data['qc'])
 
     if len(sites_list) == 1:
-        df  = get_heat_matrix_df(qc, sites, color_mapping_list)
-        if not df.empty:
-            fig_heatmap = generate_heat_matrix(df, color_mapping_list)
-            heatmap = html.Div([
+        fig_heatmap = get_data_table(data, 'heatmap_figure', sites, 0)
+        if fig_heatmap is not None:
+            subjects = len(get_data_table(data, 'heat_matrix', sites))
+            pages = max(1, math.ceil(subjects / HEATMAP_PAGE_SIZE))
+            fig_strip = get_data_table(data, 'heatmap_strip', sites)
+            strip = []
+            if fig_strip is not None:
+                strip = [html.H4('Mean rating by acquisition week'), dcc.Graph(id='graph_heatmap_strip', figure=fig_strip)]
+            heatmap = html.Div(strip + [
+                html.H4('Ratings by subject ({} subjects, {} per page)'.format(subjects, HEATMAP_PAGE_SIZE)),
+                dbc.Pagination(id='heatmap-pages', max_value=pages, active_page=1, fully_expanded=False,
+                               previous_next=True, style={'display': 'flex' if pages > 1 else 'none'}),
                 dcc.Graph(id='graph_heatmap', figure=fig_heatmap)
             ])
         else:
@@ -787,6 +852,18 @@ def update_heatmap(sites, data):
 
     return heatmap
 
+@app.callback(
+    Output('graph_heatmap', 'figure'),
+    Input('heatmap-pages', 'active_page'),
+    State('dropdown-sites', 'value'),
+    State('filtered_data', 'data'),
+    prevent_initial_call=True
+)
+def update_heatmap_page(page, sites, data):
+    fig_heatmap = get_data_table(data, 'heatmap_figure', sites, (page or 1) - 1)
+    if fig_heatmap is None:
+        raise PreventUpdate
+    return fig_heatmap
 
 # ----------------------------------------------------------------------------
 # RUN APPLICATION
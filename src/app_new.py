@@ -335,19 +335,19 @@ def serve_data_stores(url_data_path, local_data_path, source):
     else:
         completions = get_completions(imaging)
         imaging_overview = roll_up(imaging)
-        indicated_received = get_indicated_received_discrepancy(imaging)
+        indicated_received = get_indicated_received(imaging)
         stacked_bar_df = get_stacked_bar_data(qc, 'sub', 'rating', ['site','ses'])
         sites = list(imaging.site.unique())
 
     data_dictionary = {
-        'imaging': imaging.to_dict('records'),
+        'imaging': encode_frame(imaging, compress=True),
         'imaging_source': imaging_source,
         'sites': sites,
-        'qc': qc.to_dict('records'),
+        'qc': encode_frame(qc, compress=True),
         'qc_source': qc_source,
-        'completions': completions.to_dict('records'),
-        'imaging_overview' : imaging_overview.to_dict('records'),
-        'indicated_received' : indicated_received.to_dict('records'),
+        'completions': encode_frame(completions),
+        'imaging_overview' : encode_frame(imaging_overview),
+        'indicated_received' : encode_frame(indicated_received, compress=True),
     }
 
     data_stores = html.Div([
@@ -398,25 +398,26 @@ app.layout = serve_layout
 )
 def filter_data(n_clicks, data, start_date, end_date):
     if start_date or end_date:
-        imaging = pd.DataFrame.from_dict(data['imaging'])
-        qc = pd.DataFrame.from_dict(data['qc'])
+        imaging = get_decoded_frame(data['imaging'])
+        qc = get_decoded_frame(data['qc'])
 
-        filtered_imaging = filter_imaging(imaging, start_date, end_date)
+        filtered_imaging = filter_imaging(imaging, pd.Timestamp(start_date) if start_date else None,
+                                          pd.Timestamp(end_date) if end_date else None)
         completions = get_completions(filtered_imaging)
         imaging_overview = roll_up(filtered_imaging)
-        indicated_received = get_indicated_received_discrepancy(filtered_imaging)
+        indicated_received = get_indicated_received(filtered_imaging)
         sites = list(filtered_imaging.site.unique())
 
         filtered_qc = filter_qc(qc, filtered_imaging)
         stacked_bar_df = get_stacked_bar_data(filtered_qc, 'sub', 'rating', ['site','ses'])
 
         filtered_data_dictionary = {
-            'imaging': filtered_imaging.to_dict('records'),
+            'imaging': encode_frame(filtered_imaging, compress=True),
             'sites': sites,
-            'qc': filtered_qc.to_dict('records'),
-            'completions': completions.to_dict('records'),
-            'imaging_overview' : imaging_overview.to_dict('records'),
-            'indicated_received' : indicated_received.to_dict('records'),
+            'qc': encode_frame(filtered_qc, compress=True),
+            'completions': encode_frame(completions),
+            'imaging_overview' : encode_frame(imaging_overview),
+            'indicated_received' : encode_frame(indicated_received, compress=True),
         }
         kids = html.Div(html.P(start_date))
     else:
@@ -458,7 +459,7 @@ def update_overview_section(filtered_data, n_clicks, all_data):
             data = all_data
     except:
         data = all_data
-    imaging_overview = pd.DataFrame.from_dict(data['imaging_overview'])
+    imaging_overview = get_decoded_frame(data['imaging_overview'])
     return create_image_overview(imaging_overview)
 
 # ----------------------------------------------------------------------------
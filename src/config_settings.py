@@ -1,10 +1,19 @@
 import os # Operating system library
 import pathlib # file paths
+import threading
+import time
+from collections import OrderedDict
+import requests
+from flask import request
 
 # ----------------------------------------------------------------------------
 # CONFIG SETTINGS
 # ----------------------------------------------------------------------------
 DATA_PATH = pathlib.Path(__file__).parent.joinpath("data")
+MIRROR_PATH = pathlib.Path(os.environ.get("MIRROR_PATH", DATA_PATH.joinpath("mirror")))
+BINARY_PATH = pathlib.Path(os.environ.get("BINARY_PATH", DATA_PATH.joinpath("binary")))
+# Binary copies of mirrored files, where only the latest copy of each file is kept
+MIRROR_BINARY_PATH = BINARY_PATH.joinpath("mirror")
 DATA_SOURCE = 'url'
 ASSETS_PATH = pathlib.Path(__file__).parent.joinpath("assets", "/assets")
 REQUESTS_PATHNAME_PREFIX = os.environ.get("REQUESTS_PATHNAME_PREFIX", "/")
@@ -20,13 +29,86 @@ init_api_data = {
 
 file_list = ['imaging-log-latest.csv', 'qc-log-latest.csv']
 
+# Seconds to wait on the data API before a download is abandoned
+DATA_FETCH_TIMEOUT = float(os.environ.get("DATA_FETCH_TIMEOUT", 60))
+
+# Days after surgery before a V3 scan without BIDS data is reported as overdue
+OVERDUE_V3_WINDOW = int(os.environ.get("OVERDUE_V3_WINDOW", 90))
+
+# Seconds between background refreshes of the data snapshot, and between retries after a failed refresh
+DATA_REFRESH_INTERVAL = int(os.environ.get("DATA_REFRESH_INTERVAL", 30 * 60))
+DATA_REFRESH_RETRY = int(os.environ.get("DATA_REFRESH_RETRY", 60))
+
+# Folder shared by all worker processes for the data snapshot (e.g. under /dev/shm). When set, one
+# worker refreshes the data and the others map its tables read-only, checking for a new generation
+# every SHARED_SNAPSHOT_POLL seconds. When unset every worker loads its own copy.
+SHARED_SNAPSHOT_PATH = os.environ.get("SHARED_SNAPSHOT_PATH", None)
+SHARED_SNAPSHOT_POLL = int(os.environ.get("SHARED_SNAPSHOT_POLL", 10))
+
+# Number of data snapshot versions each worker keeps, so pages opened before a refresh keep reading the
+# data they were rendered from. The shared snapshot folder also keeps the current and previous versions.
+DATA_SNAPSHOT_HISTORY = int(os.environ.get("DATA_SNAPSHOT_HISTORY", 2))
+
+# Number of date filtered sets of report tables each worker keeps in memory, and the memory (MB) they
+# and the frames decoded from store payloads may use
+FILTERED_DATA_CACHE_SIZE = int(os.environ.get("FILTERED_DATA_CACHE_SIZE", 8))
+FILTERED_DATA_CACHE_MB = int(os.environ.get("FILTERED_DATA_CACHE_MB", 256))
+DECODED_FRAME_CACHE_MB = int(os.environ.get("DECODED_FRAME_CACHE_MB", 64))
+
+# Threads used to build the report tables and figures of a new data snapshot
+DATA_WARM_WORKERS = int(os.environ.get("DATA_WARM_WORKERS", 4))
+
 # ----------------------------------------------------------------------------
 # SECURITY FUNCTION
 # ----------------------------------------------------------------------------
+# Seconds to wait on the sessions API, seconds a validated session id is trusted before it is checked
+# again, and the most session ids kept in the cache
+DJANGO_LOGIN_TIMEOUT = float(os.environ.get("DJANGO_LOGIN_TIMEOUT", 5))
+SESSION_CACHE_TTL = int(os.environ.get("SESSION_CACHE_TTL", 300))
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", 1000))
+
+# Validated sessions: session id -> (time validated, sessions API response)
+_session_cache = OrderedDict()
+_session_cache_lock = threading.Lock()
+session_cache_stats = {'hits': 0, 'misses': 0}
+
+# One pooled HTTP session per process, so repeated checks reuse the connection to the sessions API.
+# It is created on first use so gunicorn workers forked after --preload do not share sockets.
+_django_session = {'pid': None, 'session': None}
+
+def get_django_session():
+    '''Return this process's pooled requests session for the sessions API'''
+    if _django_session['pid'] != os.getpid():
+        _django_session['session'] = requests.Session()
+        _django_session['pid'] = os.getpid()
+    return _django_session['session']
+
+def get_cached_session(session_id, ttl=SESSION_CACHE_TTL):
+    '''Return the cached sessions API response for session_id, or None if it is missing or expired'''
+    with _session_cache_lock:
+        cached = _session_cache.get(session_id)
+        if cached is not None and time.monotonic() - cached[0] < ttl:
+            _session_cache.move_to_end(session_id)
+            session_cache_stats['hits'] += 1
+            return cached[1]
+        if cached is not None:
+            del _session_cache[session_id]
+        session_cache_stats['misses'] += 1
+        return None
+
+def cache_session(session_id, user, size=SESSION_CACHE_SIZE):
+    '''Store a validated session, dropping the least recently used sessions beyond size'''
+    with _session_cache_lock:
+        _session_cache[session_id] = (time.monotonic(), user)
+        _session_cache.move_to_end(session_id)
+        while len(_session_cache) > size:
+            _session_cache.popitem(last=False)
+
 def get_django_user():
     """
     Utility function to retrieve logged in username
-    from Django
+    from Django. Validated sessions are cached for
+    SESSION_CACHE_TTL seconds.
     """
     DJANGO_LOGIN_HOST = os.environ.get("DJANGO_LOGIN_HOST", None)
     SESSIONS_API_KEY = os.environ.get("SESSIONS_API_KEY", None)
@@ -38,18 +120,24 @@ def get_django_user():
             raise Exception("sessionid cookie is missing")
         if not SESSIONS_API_KEY:
             raise Exception("SESSIONS_API_KEY not configured")
+        user = get_cached_session(session_id)
+        if user is not None:
+            return user
         api = "{django_login_host}/api/sessions_api/".format(
             django_login_host=DJANGO_LOGIN_HOST
         )
-        response = requests.get(
+        response = get_django_session().get(
             api,
             params={
                 "session_key": session_id,
                 "sessions_api_key": SESSIONS_API_KEY
-            }
+            },
+            timeout=DJANGO_LOGIN_TIMEOUT
         )
-        return response.json()
+        user = response.json()
+        if response.ok and user:
+            cache_session(session_id, user)
+        return user
     except Exception as e:
         print(e)
         return None
-
@@ -3,9 +3,24 @@
 # File Management
 import os # Operating system library
 import pathlib # file paths
+import io
 import json
+import re
 import requests
 import math
+import operator
+import hashlib
+import base64
+import zlib
+import shutil
+import threading
+import time
+from collections import OrderedDict
+try:
+    import fcntl # file locks for the shared snapshot; not available on Windows
+except ImportError:
+    fcntl = None
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import numpy as np
 import pandas as pd # Dataframe manipulations
 import datetime
@@ -13,38 +28,898 @@ from datetime import date
 from datetime import datetime, timedelta
 from config_settings import *
 
+if fcntl is None:
+    # The shared snapshot relies on file locks to pick the refreshing process
+    SHARED_SNAPSHOT_PATH = None
+
+# ----------------------------------------------------------------------------
+# DATA SCHEMAS
+# ----------------------------------------------------------------------------
+# Declared column types for the data logs. 'category' columns are low cardinality text, 'flag'
+# columns hold 0/1 values and are stored as int8, and 'date' columns are parsed once on load.
+imaging_schema = {
+    'category': ['site', 'visit'],
+    'flag': ['T1 Indicated', 'T1 Received',
+             'DWI Indicated', 'DWI Received',
+             'fMRI Individualized Pressure Indicated', 'fMRI Individualized Pressure Received',
+             'fMRI Standard Pressure Indicated', 'fMRI Standard Pressure Received',
+             '1st Resting State Indicated', '1st Resting State Received',
+             '2nd Resting State Indicated', '2nd Resting State Received',
+             'dicom', 'bids', 'bids_validation'],
+    'date': ['acquisition_week', 'Surgery Week'],
+}
+
+qc_schema = {
+    'category': ['site', 'ses', 'scan', 'rating', 'source'],
+    'flag': [],
+    'date': [],
+}
+
+# Columns that failed their schema on the last load, by data set name
+data_schema_issues = {}
+
+def apply_schema(df, schema, name=''):
+    '''Convert the columns of df to the types declared in schema. Columns that are missing or do not fit
+    their declared type are reported, recorded in data_schema_issues and left as they are (flags with
+    missing values are kept as float32).'''
+    issues = []
+    converted = {}
+    for col in schema['category']:
+        if col not in df.columns:
+            issues.append(col + ': missing')
+        elif not pd.api.types.is_categorical_dtype(df[col]):
+            converted[col] = df[col].astype('category')
+    for col in schema['flag']:
+        if col not in df.columns:
+            issues.append(col + ': missing')
+            continue
+        values = pd.to_numeric(df[col], errors='coerce')
+        if values.notna().sum() < df[col].notna().sum():
+            issues.append(col + ': non-numeric values')
+        elif not values.dropna().isin([0, 1]).all():
+            issues.append(col + ': values other than 0/1')
+        elif values.isna().any():
+            issues.append(col + ': {} missing values'.format(values.isna().sum()))
+            converted[col] = values.astype('float32')
+        else:
+            converted[col] = values.astype('int8')
+    for col in schema['date']:
+        if col not in df.columns:
+            issues.append(col + ': missing')
+        elif not pd.api.types.is_datetime64_any_dtype(df[col]):
+            dates = pd.to_datetime(df[col], errors='coerce')
+            if dates.notna().sum() < df[col].notna().sum():
+                issues.append(col + ': unparseable dates')
+            converted[col] = dates
+    if issues:
+        print('Schema issues in {}: {}'.format(name, '; '.join(issues)))
+    data_schema_issues[name] = issues
+    if converted:
+        df = df.assign(**converted)
+    return df
+
+def read_csv_schema(filepath_or_buffer, schema, name='', sep=','):
+    '''Read a csv file, loading the category columns of the schema directly as categoricals'''
+    df = pd.read_csv(filepath_or_buffer, sep=sep, dtype={col: 'category' for col in schema['category']})
+    return apply_schema(df, schema, name)
+
+def frame_to_records(df):
+    '''Convert a dataframe to a list of records for a dcc.Store or DataTable, with dates as YYYY-MM-DD text'''
+    date_cols = [col for col in df.columns if pd.api.types.is_datetime64_any_dtype(df[col])]
+    if date_cols:
+        df = df.assign(**{col: df[col].dt.strftime('%Y-%m-%d') for col in date_cols})
+    return df.to_dict('records')
+
+def as_datetime(series):
+    '''Return series as datetimes, parsing it only if it is not already a datetime column'''
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    return pd.to_datetime(series, errors='coerce')
+
+# ----------------------------------------------------------------------------
+# MEMORY CAPPED CACHES
+# ----------------------------------------------------------------------------
+# Small per-process LRU caches of dataframes, shared by all callbacks in a worker. Each cache is a
+# dictionary holding its entries, their total size in bytes and hit / miss counters. The least recently
+# used entries are dropped when the cache holds more than max_items entries or max_bytes bytes.
+def make_lru_cache(max_bytes, max_items=None):
+    return {'items': OrderedDict(), 'bytes': 0, 'max_bytes': max_bytes, 'max_items': max_items,
+            'hits': 0, 'misses': 0, 'lock': threading.Lock()}
+
+def get_value_bytes(value):
+    '''Return the memory used by the dataframes in value (a dataframe, or a dictionary or list of them)'''
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, dict):
+        if 'lock' in value:
+            # A table set, whose size grows as its tables are computed (see lru_add_bytes)
+            return 0
+        return sum(get_value_bytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(get_value_bytes(v) for v in value)
+    return 0
+
+def lru_get(cache, key):
+    '''Return the cached value for key, or None'''
+    with cache['lock']:
+        entry = cache['items'].get(key)
+        if entry is None:
+            cache['misses'] += 1
+            return None
+        cache['items'].move_to_end(key)
+        cache['hits'] += 1
+        return entry[0]
+
+def lru_put(cache, key, value):
+    '''Add value to the cache, evicting least recently used entries to stay within its limits.
+    A value larger than the whole cache is returned without being stored.'''
+    size = get_value_bytes(value)
+    if size > cache['max_bytes']:
+        return value
+    with cache['lock']:
+        items = cache['items']
+        if key in items:
+            cache['bytes'] -= items.pop(key)[1]
+        items[key] = (value, size)
+        cache['bytes'] += size
+        while items and (cache['bytes'] > cache['max_bytes'] or
+                         (cache['max_items'] and len(items) > cache['max_items'])):
+            cache['bytes'] -= items.popitem(last=False)[1][1]
+    return value
+
+def lru_add_bytes(cache, key, size):
+    '''Count size more bytes for the cached entry key, evicting other entries if the cache is now full'''
+    with cache['lock']:
+        items = cache['items']
+        if key not in items:
+            return
+        value, entry_size = items[key]
+        items[key] = (value, entry_size + size)
+        cache['bytes'] += size
+        while len(items) > 1 and cache['bytes'] > cache['max_bytes']:
+            oldest = next(iter(items))
+            if oldest == key:
+                items.move_to_end(key)
+                oldest = next(iter(items))
+            cache['bytes'] -= items.pop(oldest)[1]
+
+# ----------------------------------------------------------------------------
+# COMPACT FRAME ENCODING
+# ----------------------------------------------------------------------------
+# Dataframes that have to be sent to the browser in a dcc.Store are encoded by column instead of as
+# records, so column names are not repeated on every row. Text and categorical columns are sent as
+# integer codes plus the list of distinct values, and the whole payload can be zlib compressed.
+def encode_frame(df, compress=False):
+    '''Encode a dataframe as a JSON serializable dictionary of column arrays. With compress=True the
+    JSON text is zlib compressed and base64 encoded.'''
+    columns = []
+    for col in df.columns:
+        series = df[col]
+        if pd.api.types.is_categorical_dtype(series):
+            column = {'kind': 'category', 'codes': series.cat.codes.tolist(),
+                      'values': series.cat.categories.tolist()}
+        elif pd.api.types.is_datetime64_any_dtype(series):
+            column = {'kind': 'datetime', 'data': series.dt.strftime('%Y-%m-%d %H:%M:%S').where(series.notna(), None).tolist()}
+        elif series.dtype == object:
+            codes, values = pd.factorize(series)
+            column = {'kind': 'object', 'codes': codes.tolist(), 'values': values.tolist()}
+        else:
+            column = {'kind': 'array', 'dtype': str(series.dtype),
+                      'data': series.astype(object).where(series.notna(), None).tolist()}
+        column['name'] = col
+        columns.append(column)
+    encoded = {'length': len(df), 'columns': columns}
+    if compress:
+        text = json.dumps(encoded, default=str).encode()
+        encoded = {'zlib': base64.b64encode(zlib.compress(text)).decode('ascii')}
+    return encoded
+
+def decode_frame(encoded):
+    '''Rebuild a dataframe from encode_frame output. Lists of records are also accepted.'''
+    if isinstance(encoded, list):
+        return pd.DataFrame.from_dict(encoded)
+    if 'zlib' in encoded:
+        encoded = json.loads(zlib.decompress(base64.b64decode(encoded['zlib'])))
+    data = {}
+    for column in encoded['columns']:
+        kind = column['kind']
+        if kind == 'category':
+            values = pd.Categorical.from_codes(column['codes'], column['values'])
+        elif kind == 'object':
+            # Code -1 (missing) picks the NaN appended to the values
+            values = np.array(column['values'] + [np.nan], dtype=object)[column['codes']]
+        elif kind == 'datetime':
+            values = pd.to_datetime(pd.Series(column['data'], dtype=object))
+        else:
+            try:
+                values = np.array(column['data'], dtype=column['dtype'])
+            except (TypeError, ValueError):
+                # Columns with missing values come back as floats (or objects if not numeric)
+                values = pd.Series(column['data'], dtype=object).infer_objects()
+        data[column['name']] = values
+    return pd.DataFrame(data, index=pd.RangeIndex(encoded['length']), columns=[c['name'] for c in encoded['columns']])
+
+# Frames decoded from store payloads, keyed by a fingerprint of the payload
+_decoded_frames = make_lru_cache(DECODED_FRAME_CACHE_MB * 2**20)
+
+def get_frame_fingerprint(encoded):
+    '''Return a hash of an encoded frame (or list of records) to use as its cache key'''
+    if isinstance(encoded, dict) and 'zlib' in encoded:
+        text = encoded['zlib']
+    else:
+        text = json.dumps(encoded, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+def get_decoded_frame(encoded):
+    '''Return decode_frame(encoded), reusing the frame already decoded from the same payload in this
+    worker. The returned dataframe is shared and must not be modified in place.'''
+    key = get_frame_fingerprint(encoded)
+    df = lru_get(_decoded_frames, key)
+    if df is None:
+        df = lru_put(_decoded_frames, key, decode_frame(encoded))
+    return df
+
+# ----------------------------------------------------------------------------
+# FETCH DATA
+# ----------------------------------------------------------------------------
+# Parsed copies of mirrored files, keyed by file path: {'hash': content hash, 'data': dataframe}
+_parsed_files = {}
+
+def fetch_data_file(url_data_path, file_name, mirror_path=MIRROR_PATH, timeout=DATA_FETCH_TIMEOUT):
+    '''Download file_name from url_data_path into the local mirror folder. If a mirrored copy exists
+    the request is revalidated with the ETag / Last-Modified values the server sent for it, and the
+    download is compared to the mirrored copy by content hash when the server sends neither.
+    Returns a dictionary with the mirrored file path, the content hash and the fetch status.'''
+    file_path = os.path.join(mirror_path, file_name)
+    os.makedirs(mirror_path, exist_ok=True)
+    # Processes fetching the same file take turns, so a mirrored file and its .meta.json are always
+    # written as a pair and the validators never describe another process's content
+    with open(file_path + '.lock', 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return _fetch_mirrored_file(url_data_path, file_name, file_path, timeout)
+
+def _fetch_mirrored_file(url_data_path, file_name, file_path, timeout):
+    meta_path = file_path + '.meta.json'
+    meta = {}
+    if os.path.exists(file_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    response = requests.get('/'.join([url_data_path, file_name]), headers=headers, timeout=timeout)
+    if response.status_code == 304 and meta:
+        return {'path': file_path, 'hash': meta['hash'], 'status': 'not modified'}
+    response.raise_for_status()
+
+    content_hash = hashlib.sha256(response.content).hexdigest()
+    if content_hash == meta.get('hash'):
+        status = 'unchanged'
+    else:
+        status = 'downloaded'
+        # Write to a temporary file first so readers never see a partial file
+        tmp_path = '{}.{}.tmp'.format(file_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(response.content)
+        os.replace(tmp_path, file_path)
+
+    meta = {
+        'url': response.url,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'hash': content_hash,
+        'date_request': datetime.now().isoformat(),
+    }
+    tmp_path = '{}.{}.tmp'.format(meta_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+    return {'path': file_path, 'hash': content_hash, 'status': status}
+
+def read_data_file(url_data_path, file_name, schema, incremental=False, mirror_path=MIRROR_PATH, timeout=DATA_FETCH_TIMEOUT,
+                   binary_path=MIRROR_BINARY_PATH):
+    '''Fetch file_name through the local mirror and return it as a dataframe typed by schema. The file
+    is only parsed again when its content hash differs from the last parsed copy, and append-only files
+    read with incremental=True only parse their new rows. Only the binary copy of the latest content is
+    kept. The returned dataframe is shared between callers and should not be modified in place.'''
+    fetched = fetch_data_file(url_data_path, file_name, mirror_path, timeout)
+    parsed = _parsed_files.get(fetched['path'])
+    if parsed is None or parsed['hash'] != fetched['hash']:
+        if incremental:
+            df = ingest_csv_incremental(fetched['path'], schema, file_name, binary_path=binary_path, keep_latest=True)
+        else:
+            df = ingest_csv(fetched['path'], schema, file_name, binary_path=binary_path, keep_latest=True)
+        parsed = {'hash': fetched['hash'], 'data': df}
+        _parsed_files[fetched['path']] = parsed
+    return parsed['data']
+
+# ----------------------------------------------------------------------------
+# BINARY DATA FILES
+# ----------------------------------------------------------------------------
+# Ingested csv files are stored as a folder holding one .npy array per column and a manifest.json
+# describing the columns. Text columns are stored as integer codes with the list of their values in
+# the manifest, so no column needs pickling and every array can be memory mapped. Columns of date
+# objects (as in the report tables) are stored as datetime64 values.
+BINARY_FORMAT_VERSION = 1
+
+def write_frame_columns(df, frame_path, schema_issues=None):
+    '''Write the dataframe to frame_path in the columnar binary format. The folder is written under a
+    temporary name and renamed into place, so readers only ever see a complete folder.'''
+    tmp_path = '{}.{}.tmp'.format(frame_path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    columns = []
+    for i, col in enumerate(df.columns):
+        values = df[col]
+        column = {'name': col, 'file': 'col-{}.npy'.format(i)}
+        if pd.api.types.is_categorical_dtype(values):
+            column.update(kind='category', categories=values.cat.categories.tolist(),
+                          ordered=bool(values.cat.ordered))
+            array = values.cat.codes.to_numpy()
+        elif values.dtype == object and isinstance(next(iter(values.dropna()), None), date):
+            column.update(kind='date')
+            array = pd.to_datetime(values).to_numpy()
+        elif values.dtype == object:
+            codes, uniques = pd.factorize(values)
+            column.update(kind='object', categories=uniques.tolist())
+            array = codes.astype('int32')
+        else:
+            column.update(kind='array')
+            array = values.to_numpy()
+        np.save(os.path.join(tmp_path, column['file']), array, allow_pickle=False)
+        columns.append(column)
+    manifest = {'format': BINARY_FORMAT_VERSION, 'rows': len(df), 'columns': columns,
+                'schema_issues': schema_issues or []}
+    with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    try:
+        os.rename(tmp_path, frame_path)
+    except OSError:
+        # Another process wrote the same content first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return frame_path
+
+def read_frame_columns(frame_path, mmap_mode=None):
+    '''Read a dataframe written by write_frame_columns. With mmap_mode='r' the numeric arrays are
+    mapped read-only from the files rather than read into memory.'''
+    with open(os.path.join(frame_path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    data = {}
+    for column in manifest['columns']:
+        array = np.load(os.path.join(frame_path, column['file']), mmap_mode=mmap_mode, allow_pickle=False)
+        if column['kind'] == 'category':
+            data[column['name']] = pd.Categorical.from_codes(array, categories=column['categories'],
+                                                             ordered=column['ordered'])
+        elif column['kind'] == 'object':
+            categories = np.array(column['categories'] + [np.nan], dtype=object)
+            data[column['name']] = categories[array]
+        elif column['kind'] == 'date':
+            data[column['name']] = pd.DatetimeIndex(array).date
+        else:
+            data[column['name']] = array
+    # copy=False keeps the (mapped) arrays as they are instead of consolidating them into new blocks
+    return pd.DataFrame(data, index=pd.RangeIndex(manifest['rows']), columns=[c['name'] for c in manifest['columns']], copy=False)
+
+def get_binary_frame_path(csv_path, content, schema, binary_path=BINARY_PATH):
+    '''Return the binary folder path for a csv file, keyed by a hash of its content and of the schema'''
+    content_hash = hashlib.sha256(content)
+    content_hash.update(json.dumps([BINARY_FORMAT_VERSION, schema], sort_keys=True).encode())
+    stem = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(binary_path, '{}-{}'.format(stem, content_hash.hexdigest()[:16]))
+
+def prune_binary_copies(frame_path):
+    '''Remove the binary copies of earlier contents of the same csv file from frame_path's folder'''
+    folder, name = os.path.split(frame_path)
+    stem = name.rsplit('-', 1)[0]
+    for other in os.listdir(folder):
+        if other != name and re.fullmatch(re.escape(stem) + '-[0-9a-f]{16}', other):
+            shutil.rmtree(os.path.join(folder, other), ignore_errors=True)
+
+def ingest_csv(csv_path, schema, name='', sep=',', binary_path=BINARY_PATH, keep_latest=False):
+    '''Return the csv file as a dataframe typed by schema, loading it from its binary copy if one
+    exists for this content and otherwise parsing the csv and writing the binary copy. With
+    keep_latest=True the copies of earlier contents of the file are removed when a new one is written,
+    so binary_path must not hold other files with the same name.'''
+    with open(csv_path, 'rb') as f:
+        content = f.read()
+    frame_path = get_binary_frame_path(csv_path, content, schema, binary_path)
+    if os.path.isdir(frame_path):
+        try:
+            df = read_frame_columns(frame_path)
+            with open(os.path.join(frame_path, 'manifest.json')) as f:
+                data_schema_issues[name] = json.load(f)['schema_issues']
+            return df
+        except (OSError, ValueError, KeyError) as e:
+            print('Could not read {}: {}'.format(frame_path, e))
+            shutil.rmtree(frame_path, ignore_errors=True)
+
+    df = read_csv_schema(io.BytesIO(content), schema, name, sep=sep)
+    try:
+        os.makedirs(binary_path, exist_ok=True)
+        write_frame_columns(df, frame_path, data_schema_issues.get(name))
+        if keep_latest:
+            prune_binary_copies(frame_path)
+    except OSError as e:
+        print('Could not write {}: {}'.format(frame_path, e))
+    return df
+
+def ingest_data_files(data_path=DATA_PATH, binary_path=BINARY_PATH):
+    '''Ingest every csv file in the data folder and its archive folder into the binary format'''
+    empty_schema = {'category': [], 'flag': [], 'date': []}
+    ingested = []
+    for folder in [data_path, os.path.join(data_path, 'archive')]:
+        for file_name in sorted(os.listdir(folder)):
+            csv_path = os.path.join(folder, file_name)
+            if not file_name.endswith('.csv'):
+                continue
+            if file_name.startswith('imaging'):
+                schema = imaging_schema
+            elif file_name.startswith('qc'):
+                schema = qc_schema
+            else:
+                schema = empty_schema
+            with open(csv_path) as f:
+                header = f.readline()
+            sep = '\t' if '\t' in header and ',' not in header else ','
+            ingest_csv(csv_path, schema, file_name, sep=sep, binary_path=binary_path)
+            ingested.append(csv_path)
+    return ingested
+
+# ----------------------------------------------------------------------------
+# INCREMENTAL INGEST
+# ----------------------------------------------------------------------------
+# Append-only logs such as the qc log are re-read by parsing only the rows added since the last read.
+# The state kept for each file records how many bytes were parsed and a hash of those bytes; if that
+# prefix of the file has changed the whole file is loaded again.
+_incremental_files = {}
+
+def append_schema_rows(df, new_rows, schema):
+    '''Append new_rows to df, merging the categories of the schema's category columns'''
+    combined = pd.concat([df, new_rows], ignore_index=True)
+    for col in schema['category']:
+        if col in df.columns and pd.api.types.is_categorical_dtype(df[col]) and pd.api.types.is_categorical_dtype(new_rows[col]):
+            combined[col] = pd.api.types.union_categoricals([df[col], new_rows[col]], ignore_order=True)
+    return combined
+
+def read_csv_rows(header, rows, schema, name=''):
+    '''Parse csv rows that follow the header line, typed by schema'''
+    return read_csv_schema(io.BytesIO(header + rows), schema, name)
+
+def ingest_csv_incremental(csv_path, schema, name='', binary_path=BINARY_PATH, keep_latest=False):
+    '''Return the csv file as a dataframe typed by schema. If the file starts with the same bytes as
+    when it was last read by this process, only the rows after them are parsed and appended to the
+    previous dataframe; otherwise the whole file is loaded with ingest_csv. Only complete lines are
+    kept for the next read: a last line without its newline may still be being written, so it is
+    parsed again each time until it is complete.'''
+    with open(csv_path, 'rb') as f:
+        content = f.read()
+    # End of the last complete line
+    offset = content.rfind(b'\n') + 1
+    if offset == 0:
+        # Not even a complete header line
+        return ingest_csv(csv_path, schema, name, binary_path=binary_path, keep_latest=keep_latest)
+    header = content[:content.find(b'\n') + 1]
+    partial = content[offset:]
+
+    state = _incremental_files.get(csv_path)
+    if (state is not None and offset >= state['offset']
+            and hashlib.sha256(content[:state['offset']]).hexdigest() == state['prefix_hash']):
+        df = state['data']
+        if content[state['offset']:offset].strip():
+            df = append_schema_rows(df, read_csv_rows(header, content[state['offset']:offset], schema, name), schema)
+    elif partial.strip():
+        df = read_csv_schema(io.BytesIO(content[:offset]), schema, name)
+    else:
+        df = ingest_csv(csv_path, schema, name, binary_path=binary_path, keep_latest=keep_latest)
+
+    if state is None or state['data'] is not df:
+        _incremental_files[csv_path] = {
+            'offset': offset,
+            'prefix_hash': hashlib.sha256(content[:offset]).hexdigest(),
+            'rows': len(df),
+            'data': df,
+        }
+    if partial.strip():
+        return append_schema_rows(df, read_csv_rows(header, partial, schema, name), schema)
+    return df
+
 # ----------------------------------------------------------------------------
 # LOAD DATA
 # ----------------------------------------------------------------------------
-def load_imaging(url_data_path, local_data_path, source='url'):
+def load_imaging(url_data_path, local_data_path, source='url', timeout=DATA_FETCH_TIMEOUT):
     if source == 'local':
-        imaging = pd.read_csv(os.path.join(local_data_path,'imaging-log-latest.csv'))
+        imaging = ingest_csv(os.path.join(local_data_path,'imaging-log-latest.csv'), imaging_schema, 'imaging-log-latest.csv')
         imaging_source = 'local'
     else:
         try:
-            imaging = pd.read_csv('/'.join([url_data_path,'imaging-log-latest.csv']))
+            imaging = read_data_file(url_data_path, 'imaging-log-latest.csv', imaging_schema, timeout=timeout)
             imaging_source = 'url'
         except:
             imaging = pd.DataFrame()
             imaging_source = 'unavailable'
     return imaging, imaging_source
 
-def load_qc(url_data_path, local_data_path, source='url'):
+def load_qc(url_data_path, local_data_path, source='url', timeout=DATA_FETCH_TIMEOUT):
     if source == 'local':
-        qc = pd.read_csv(os.path.join(local_data_path,'qc-log-latest.csv'))
+        qc = ingest_csv_incremental(os.path.join(local_data_path,'qc-log-latest.csv'), qc_schema, 'qc-log-latest.csv')
         qc_source = 'local'
     else:
         try:
-            qc = pd.read_csv('/'.join([url_data_path,'qc-log-latest.csv']))
+            # The qc log only has rows appended, so only the new rows are parsed on refresh
+            qc = read_data_file(url_data_path, 'qc-log-latest.csv', qc_schema, incremental=True, timeout=timeout)
             qc_source = 'url'
         except:
             qc = pd.DataFrame()
             qc_source = 'unavailable'
     if 'scan' in qc.columns:
         # Change scan name in qc file to match imaging file
-        qc.loc[qc['scan'] == 'T1w', 'scan']  = 'T1'
+        qc = qc.assign(scan = qc['scan'].replace('T1w', 'T1'))
     return qc, qc_source
 
+# Loader for each data file used by the report. Loaders take (url_data_path, local_data_path, source, timeout)
+# and return (dataframe, source); files added here are fetched alongside the others.
+data_file_loaders = {
+    'imaging': load_imaging,
+    'qc': load_qc,
+}
+
+def load_data_files(url_data_path, local_data_path, source, loaders=None, timeout=DATA_FETCH_TIMEOUT):
+    '''Run the data file loaders concurrently and return a dictionary of {name: (dataframe, source)}.
+    Each file gets its own timeout; a file that has not loaded in time is returned empty as unavailable.'''
+    if loaders is None:
+        loaders = data_file_loaders
+    executor = ThreadPoolExecutor(max_workers=len(loaders))
+    try:
+        futures = {name: executor.submit(loader, url_data_path, local_data_path, source, timeout)
+                   for name, loader in loaders.items()}
+        deadline = time.time() + timeout
+        data_files = {}
+        for name, future in futures.items():
+            try:
+                data_files[name] = future.result(timeout=max(0, deadline - time.time()))
+            except FutureTimeoutError:
+                print('Timed out loading ' + name)
+                data_files[name] = (pd.DataFrame(), 'unavailable')
+    finally:
+        # Do not wait on a download that timed out; its thread ends with the request timeout
+        executor.shutdown(wait=False)
+    return data_files
+
+def load_data_source(url_data_path, local_data_path, source):
+    data_files = load_data_files(url_data_path, local_data_path, source)
+    imaging, imaging_source = data_files['imaging']
+    qc, qc_source = data_files['qc']
+
+    return imaging, imaging_source, qc, qc_source
+
+# ----------------------------------------------------------------------------
+# DATA SNAPSHOTS
+# ----------------------------------------------------------------------------
+# Snapshots are plain dictionaries that are never modified once published. The background
+# refresher builds a complete new snapshot and swaps the reference, so requests that already
+# hold the old snapshot finish on it. Page requests only ever read the published snapshot.
+_data_snapshots = {}
+# The last DATA_SNAPSHOT_HISTORY published snapshots of each source, by version
+_snapshot_history = {}
+_data_refreshers = {}
+_data_refresher_lock = threading.Lock()
+
+def get_snapshot_version(*frames):
+    '''Return a short content hash of the data frames to use as the snapshot version id'''
+    version_hash = hashlib.sha1()
+    for df in frames:
+        version_hash.update(','.join(map(str, df.columns)).encode())
+        version_hash.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return version_hash.hexdigest()[:12]
+
+def get_snapshot_key(url_data_path, local_data_path, source):
+    return (url_data_path, str(local_data_path), source)
+
+def publish_data_snapshot(key, snapshot):
+    '''Publish the snapshot for the source key, keeping it reachable by its version after later refreshes'''
+    _data_snapshots[key] = snapshot
+    if snapshot['version'] is not None:
+        history = _snapshot_history.setdefault(key, OrderedDict())
+        history[snapshot['version']] = snapshot
+        history.move_to_end(snapshot['version'])
+        while len(history) > DATA_SNAPSHOT_HISTORY:
+            history.popitem(last=False)
+
+def make_data_snapshot(imaging, qc, source, status, refreshed, checked, **details):
+    '''Package the imaging and qc data, with the derived tables for the unfiltered report, as a snapshot'''
+    if imaging.empty or qc.empty:
+        sites = []
+    else:
+        sites = list(imaging.site.unique())
+    snapshot = {
+        'version': get_snapshot_version(imaging, qc),
+        'source': source,
+        'status': status,
+        'refreshed': refreshed,
+        'checked': checked,
+        'imaging': imaging,
+        'qc': qc,
+        'sites': sites,
+        'tables': make_table_set(imaging, qc),
+    }
+    snapshot.update(details)
+    return snapshot
+
+def build_data_snapshot(url_data_path, local_data_path, source):
+    '''Load the imaging and qc logs and package them as a new data snapshot'''
+    imaging, imaging_source, qc, qc_source = load_data_source(url_data_path, local_data_path, source)
+    now = time.time()
+    if imaging.empty or qc.empty:
+        status = 'unavailable'
+    else:
+        status = 'ok'
+    return make_data_snapshot(imaging, qc, source, status, now, now)
+
+def refresh_data_snapshot(url_data_path, local_data_path, source, shared_path=SHARED_SNAPSHOT_PATH):
+    '''Build a new data snapshot and publish it. If the data could not be loaded the previous
+    snapshot stays published, marked with the failed refresh.'''
+    key = get_snapshot_key(url_data_path, local_data_path, source)
+    try:
+        snapshot = build_data_snapshot(url_data_path, local_data_path, source)
+    except Exception as e:
+        print(e)
+        snapshot = None
+    previous = _data_snapshots.get(key)
+    if snapshot is None or snapshot['status'] != 'ok':
+        if previous and previous['sites']:
+            snapshot = dict(previous, status='refresh failed', checked=time.time())
+            if not is_table_set_current(snapshot['tables']):
+                snapshot['tables'] = make_table_set(snapshot['imaging'], snapshot['qc'])
+        elif snapshot is None:
+            snapshot = get_empty_snapshot(source, 'unavailable')
+    elif previous and previous['version'] == snapshot['version'] and is_table_set_current(previous['tables']):
+        # Unchanged data keeps the tables and figures already computed for it that day
+        snapshot['tables'] = previous['tables']
+    if shared_path:
+        write_shared_snapshot(snapshot, shared_path)
+        return map_shared_snapshot(key, shared_path)
+    if previous is None or previous['tables'] is not snapshot['tables']:
+        warm_table_set(snapshot['tables'], snapshot_warm_tables)
+    publish_data_snapshot(key, snapshot)
+    log_snapshot_memory(snapshot)
+    return snapshot
+
+def initialize_data_snapshot(url_data_path, local_data_path, source, shared_path=SHARED_SNAPSHOT_PATH,
+                             interval=DATA_REFRESH_INTERVAL, retry=DATA_REFRESH_RETRY):
+    '''Load the first data snapshot of this process. With a shared snapshot folder, the shared snapshot
+    is only rebuilt if it is missing or due for a refresh and no other process is refreshing it.'''
+    if not shared_path:
+        return refresh_data_snapshot(url_data_path, local_data_path, source, shared_path)
+    key = get_snapshot_key(url_data_path, local_data_path, source)
+    os.makedirs(shared_path, exist_ok=True)
+    meta = read_shared_generation(shared_path)
+    if meta is None or get_refresh_wait(meta, interval, retry) <= 0:
+        # Hold the refresh lock only while loading, so forked workers do not inherit it
+        with open(os.path.join(shared_path, 'refresh.lock'), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                refresh_data_snapshot(url_data_path, local_data_path, source, shared_path)
+            except BlockingIOError:
+                pass
+    return map_shared_snapshot(key, shared_path)
+
+def get_empty_snapshot(source, status):
+    now = time.time()
+    empty = pd.DataFrame()
+    return {'version': None, 'source': source, 'status': status, 'refreshed': now, 'checked': now,
+            'imaging': empty, 'qc': empty, 'sites': [], 'tables': make_table_set(empty, empty)}
+
+def get_data_snapshot(url_data_path, local_data_path, source, version=None):
+    '''Return the latest published data snapshot for this source without loading any data. With a
+    version, return the snapshot of that version while this process still keeps it, so a page keeps
+    the data it was rendered from; older versions get the latest snapshot.'''
+    key = get_snapshot_key(url_data_path, local_data_path, source)
+    snapshot = _data_snapshots.get(key)
+    if version is not None and (snapshot is None or snapshot['version'] != version):
+        snapshot = _snapshot_history.get(key, {}).get(version, snapshot)
+    if snapshot is None:
+        snapshot = get_empty_snapshot(source, 'loading')
+    return snapshot
+
+def describe_snapshot(snapshot):
+    '''Return a short message with the age and refresh status of a data snapshot'''
+    age_minutes = int((time.time() - snapshot['refreshed']) // 60)
+    if age_minutes < 1:
+        age = 'less than a minute ago'
+    elif age_minutes < 120:
+        age = '{} minutes ago'.format(age_minutes)
+    else:
+        age = '{} hours ago'.format(age_minutes // 60)
+    msg = 'loaded ' + age
+    if snapshot['status'] != 'ok':
+        msg = msg + ' (' + snapshot['status'] + ', last attempt ' + datetime.fromtimestamp(snapshot['checked']).strftime('%H:%M') + ')'
+    return msg
+
+def get_refresh_wait(snapshot, interval, retry):
+    '''Return the seconds until the snapshot is due for a refresh'''
+    if snapshot['status'] == 'ok':
+        return snapshot['refreshed'] + interval - time.time()
+    return snapshot['checked'] + retry - time.time()
+
+def _refresh_data_loop(url_data_path, local_data_path, source, interval, retry):
+    key = get_snapshot_key(url_data_path, local_data_path, source)
+    while True:
+        snapshot = _data_snapshots.get(key)
+        if snapshot is not None:
+            wait = get_refresh_wait(snapshot, interval, retry)
+            if wait > 0:
+                time.sleep(wait)
+        refresh_data_snapshot(url_data_path, local_data_path, source, None)
+
+def _refresh_shared_data_loop(url_data_path, local_data_path, source, interval, retry, shared_path, poll):
+    key = get_snapshot_key(url_data_path, local_data_path, source)
+    while True:
+        try:
+            if acquire_shared_refresh_lock(shared_path):
+                meta = read_shared_generation(shared_path)
+                if meta is None or get_refresh_wait(meta, interval, retry) <= 0:
+                    refresh_data_snapshot(url_data_path, local_data_path, source, shared_path)
+            map_shared_snapshot(key, shared_path)
+        except Exception as e:
+            print(e)
+        time.sleep(poll)
+
+def start_data_refresher(url_data_path, local_data_path, source, interval=DATA_REFRESH_INTERVAL, retry=DATA_REFRESH_RETRY,
+                         shared_path=SHARED_SNAPSHOT_PATH, poll=SHARED_SNAPSHOT_POLL):
+    '''Start a daemon thread that refreshes the data snapshot for this source in the background.
+    Threads do not survive a fork, so this is called from every worker process and only starts a
+    thread if this process does not already have a running one. With a shared snapshot folder the
+    thread refreshes the data only while its process holds the refresh lock, and otherwise maps
+    each new generation written by the process that does.'''
+    key = get_snapshot_key(url_data_path, local_data_path, source)
+    thread = _data_refreshers.get(key)
+    if thread is not None and thread.is_alive():
+        return thread
+    with _data_refresher_lock:
+        thread = _data_refreshers.get(key)
+        if thread is None or not thread.is_alive():
+            if shared_path:
+                target = _refresh_shared_data_loop
+                args = (url_data_path, local_data_path, source, interval, retry, shared_path, poll)
+            else:
+                target = _refresh_data_loop
+                args = (url_data_path, local_data_path, source, interval, retry)
+            thread = threading.Thread(target=target, name='data-refresher', daemon=True, args=args)
+            thread.start()
+            _data_refreshers[key] = thread
+    return thread
+
+# ----------------------------------------------------------------------------
+# SHARED SNAPSHOTS
+# ----------------------------------------------------------------------------
+# With SHARED_SNAPSHOT_PATH set, the process holding the refresh lock writes the imaging and qc
+# tables of each snapshot to a gen-<n> folder in the binary format, then replaces generation.json
+# to publish it. Every worker maps the tables of the current generation read-only, so the pages of
+# the data are shared between processes instead of each worker holding its own copy.
+shared_snapshot_tables = ['imaging', 'qc']
+# Report tables of the unfiltered report written with each generation. Workers map them instead of
+# building them, and so never build the large indicated_received and ratings tables they come from.
+# They are only used on the day they were computed, since overdue scans depend on the day.
+shared_report_tables = ['no_bids', 'mismatch', 'rating_counts']
+_shared_refresh_lock = {'file': None, 'pid': None}
+
+def read_shared_generation(shared_path):
+    '''Return the generation.json metadata of the shared snapshot folder, or None if there is none'''
+    try:
+        with open(os.path.join(shared_path, 'generation.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_shared_snapshot(snapshot, shared_path):
+    '''Publish the snapshot as the next generation of the shared snapshot folder. The tables are only
+    written again when the data version or the day changed; a status-only change reuses the current
+    folder.'''
+    meta = read_shared_generation(shared_path)
+    generation = meta['generation'] + 1 if meta else 1
+    tables_date = snapshot['tables']['tables']['reference_date'].isoformat()
+    if (meta and meta['version'] == snapshot['version'] and meta.get('tables_date') == tables_date
+            and os.path.isdir(os.path.join(shared_path, meta['folder']))):
+        folder = meta['folder']
+    else:
+        folder = 'gen-{}'.format(generation)
+        folder_path = os.path.join(shared_path, folder)
+        shutil.rmtree(folder_path, ignore_errors=True)
+        os.makedirs(folder_path)
+        for table in shared_snapshot_tables:
+            write_frame_columns(snapshot[table], os.path.join(folder_path, table))
+        for table in shared_report_tables:
+            write_frame_columns(get_table(snapshot['tables'], table), os.path.join(folder_path, table))
+
+    new_meta = {key: snapshot[key] for key in ['version', 'source', 'status', 'refreshed', 'checked']}
+    new_meta.update(generation=generation, folder=folder, tables_date=tables_date)
+    tmp_path = os.path.join(shared_path, 'generation.json.{}.tmp'.format(os.getpid()))
+    with open(tmp_path, 'w') as f:
+        json.dump(new_meta, f)
+    os.replace(tmp_path, os.path.join(shared_path, 'generation.json'))
+
+    # Keep the current and previous folders; processes still mapping an older one keep its pages
+    keep = [folder, meta['folder'] if meta else None]
+    for name in os.listdir(shared_path):
+        if name.startswith('gen-') and name not in keep:
+            shutil.rmtree(os.path.join(shared_path, name), ignore_errors=True)
+    return new_meta
+
+def add_shared_report_tables(table_set, folder_path, meta):
+    '''Map the report tables written with the generation into the table set, if they were computed for
+    the table set's day'''
+    if meta.get('tables_date') == table_set['tables']['reference_date'].isoformat():
+        for table in shared_report_tables:
+            table_set['tables'][table] = read_frame_columns(os.path.join(folder_path, table), mmap_mode='r')
+
+def map_shared_snapshot(key, shared_path):
+    '''Publish the current generation of the shared snapshot folder in this process, mapping its tables
+    read-only. Returns the published snapshot.'''
+    meta = read_shared_generation(shared_path)
+    current = _data_snapshots.get(key)
+    if meta is None:
+        return current
+    if current is not None and current.get('generation') == meta['generation']:
+        return current
+
+    details = {field: meta[field] for field in ['status', 'refreshed', 'checked', 'generation', 'folder']}
+    folder_path = os.path.join(shared_path, meta['folder'])
+    if current is not None and current.get('folder') == meta['folder']:
+        snapshot = dict(current, **details)
+        if not is_table_set_current(snapshot['tables']):
+            snapshot['tables'] = make_table_set(snapshot['imaging'], snapshot['qc'])
+            add_shared_report_tables(snapshot['tables'], folder_path, meta)
+            warm_table_set(snapshot['tables'], snapshot_warm_tables)
+    else:
+        tables = {table: read_frame_columns(os.path.join(folder_path, table), mmap_mode='r')
+                  for table in shared_snapshot_tables}
+        snapshot = make_data_snapshot(tables['imaging'], tables['qc'], meta['source'], **details)
+        add_shared_report_tables(snapshot['tables'], folder_path, meta)
+        warm_table_set(snapshot['tables'], snapshot_warm_tables)
+        log_snapshot_memory(snapshot)
+    publish_data_snapshot(key, snapshot)
+    return snapshot
+
+def acquire_shared_refresh_lock(shared_path):
+    '''Try to make this process the one that refreshes the shared snapshot. The lock is held until
+    the process exits, after which the next worker to try takes over.'''
+    if _shared_refresh_lock['pid'] == os.getpid():
+        return True
+    lock_file = open(os.path.join(shared_path, 'refresh.lock'), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return False
+    _shared_refresh_lock.update(file=lock_file, pid=os.getpid())
+    return True
+
+def get_memory_usage():
+    '''Return the resident (rss), proportional (pss) and shared memory of this process in MB'''
+    usage = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                field, value = line.split(':', 1)
+                if field in ['Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty']:
+                    usage[field.lower()] = round(int(value.split()[0]) / 1024, 1)
+    except OSError:
+        pass
+    return usage
+
+def log_snapshot_memory(snapshot):
+    '''Print the memory use of this process when it publishes a snapshot, to compare worker memory
+    with and without a shared snapshot folder'''
+    usage = get_memory_usage()
+    print('Process {} published data snapshot {} (generation {}): rss {} MB, pss {} MB, shared {} MB'.format(
+        os.getpid(), snapshot['version'], snapshot.get('generation', '-'), usage.get('rss'), usage.get('pss'),
+        round(usage.get('shared_clean', 0) + usage.get('shared_dirty', 0), 1)))
+
 # ----------------------------------------------------------------------------
 # Filter by date
 # ----------------------------------------------------------------------------
@@ -53,7 +928,7 @@ def filter_imaging(imaging_df, start_date: datetime = None, end_date = None):
     start_date: select imaging records acquired on or after this date
     end_date: select imaging records acquired on or before this date'''
     filtered_imaging = imaging_df.copy()
-    filtered_imaging['acquisition_week']= pd.to_datetime(filtered_imaging['acquisition_week'], errors = 'coerce')
+    filtered_imaging['acquisition_week']= as_datetime(filtered_imaging['acquisition_week'])
 
     if start_date and isinstance(start_date, datetime):
         filtered_imaging = filtered_imaging[filtered_imaging['acquisition_week'] >= start_date]
@@ -63,42 +938,82 @@ def filter_imaging(imaging_df, start_date: datetime = None, end_date = None):
 
     return filtered_imaging
 
-def filter_qc(qc, filtered_imaging):
-    '''Filter qx records to just those subjects / visits in the filtered imaging set'''
-    filt_sub = filtered_imaging[['subject_id','visit']]
-    filt_sub.columns = ['sub','ses']
-    filtered_qc = qc.merge(filt_sub, how = 'left',on = ['sub','ses'])
-    return filtered_qc
+def get_qc_keys(qc):
+    '''Return the integer (sub, ses) keys of the qc records, and the visits they are numbered by'''
+    if pd.api.types.is_categorical_dtype(qc['ses']):
+        visits = list(qc['ses'].cat.categories)
+    else:
+        visits = sorted(qc['ses'].dropna().unique())
+    return {'visits': visits, 'keys': get_visit_keys(qc['sub'], qc['ses'], visits)}
 
-# ----------------------------------------------------------------------------
-# Discrepancies Analysis
-# ----------------------------------------------------------------------------
+def get_visit_keys(subjects, visits, visit_values):
+    '''Return an integer key for each subject and visit; subjects that are missing or not a whole
+    number and visits that are missing or not in visit_values get the key -1'''
+    codes = pd.Categorical(visits, categories=visit_values).codes
+    # Subject ids are coerced like the numeric columns of the schema, so text ids and NaN never raise
+    ids = pd.to_numeric(pd.Series(subjects), errors='coerce').astype('float64').to_numpy()
+    valid = (codes >= 0) & np.isfinite(ids) & (ids >= 0) & (ids == np.floor(ids))
+    keys = np.where(valid, ids, 0).astype(np.int64) * len(visit_values) + codes
+    return np.where(valid, keys, -1)
+
+def filter_qc(qc, filtered_imaging, qc_keys=None):
+    '''Filter qc records to just those subjects / visits in the filtered imaging set. qc_keys are the keys
+    of get_qc_keys(qc), which can be built once for several filters.'''
+    if qc_keys is None:
+        qc_keys = get_qc_keys(qc)
+    imaging_keys = get_visit_keys(filtered_imaging['subject_id'], filtered_imaging['visit'], qc_keys['visits'])
+    # Semi-join: a hashed membership test of the qc keys, so qc records are neither merged nor repeated
+    # Records keyed -1 (no usable subject or visit) never match, on either side
+    filtered_qc = qc[pd.Index(qc_keys['keys']).isin(imaging_keys[imaging_keys >= 0])]
+    return filtered_qc.reset_index(drop=True)
+
+def get_ratings(indicated_received, qc):
+    '''Combine the scans of the indicated_received table with their qc ratings'''
+    ratings = indicated_received.merge(qc, how='outer', left_on = ['Site','Subject','Visit','Scan'], right_on=['site','sub','ses','scan'])
+    # 'N/A' is not one of the categories of the categorical columns, so fill them as text
+    category_cols = ratings.select_dtypes('category').columns
+    ratings = ratings.astype({col: 'object' for col in category_cols}).fillna('N/A')
+    return ratings
+
+def get_rating_counts(ratings):
+    '''Sum the BIDS values of the ratings by site, scan and rating, in order of first appearance, for
+    make_pie_chart. Groups without numeric BIDS values sum to NaN, which plotly leaves out of the pies
+    like the 'N/A' values themselves.'''
+    bids = pd.to_numeric(ratings['BIDS'], errors='coerce')
+    counts = ratings[['Site', 'Scan', 'rating']].assign(BIDS=bids)
+    return counts.groupby(['Site', 'Scan', 'rating'], sort=False)['BIDS'].sum(min_count=1).reset_index()
 
 # ----------------------------------------------------------------------------
 # Discrepancies Analysis
 # ----------------------------------------------------------------------------
 
-def calculate_overdue(BIDS, visit, surgery_week):
-    today = datetime.now().date()
-    if surgery_week is pd.NaT:
-        overdue='No Surgery Date'
-    elif BIDS == 0 and visit == 'V1' and surgery_week < today:
-        overdue = 'Yes'
-    elif BIDS == 0 and visit == 'V3' and  (today-surgery_week).days > 90:
-        overdue = 'Yes'
-    else:
-        overdue='No'
-    return overdue
+def calculate_overdue(BIDS, visit, surgery_week, reference_date=None, v3_window=OVERDUE_V3_WINDOW):
+    '''Return 'Yes', 'No' or 'No Surgery Date' for each scan: V1 scans without BIDS are overdue once
+    the surgery week has passed, and V3 scans without BIDS v3_window days after it. The reference
+    date defaults to today.'''
+    if reference_date is None:
+        reference_date = datetime.now().date()
+    surgery_week = pd.to_datetime(pd.Series(surgery_week), errors='coerce')
+    days_since_surgery = (pd.Timestamp(reference_date) - surgery_week).dt.days.to_numpy()
+    no_bids = (np.asarray(BIDS) == 0)
+    visit = np.asarray(visit, dtype=object)
+    overdue = np.select(
+        [surgery_week.isna().to_numpy(),
+         no_bids & (visit == 'V1') & (days_since_surgery > 0),
+         no_bids & (visit == 'V3') & (days_since_surgery > v3_window)],
+        ['No Surgery Date', 'Yes', 'Yes'], 'No')
+    return overdue.astype(object)
 
-def get_indicated_received(imaging_dataframe, validation_column = 'bids_validation', validation_value = 1):
+def get_indicated_received(imaging_dataframe, validation_column = 'bids_validation', validation_value = 1,
+                           reference_date = None, v3_window = OVERDUE_V3_WINDOW):
     """The get_indicated_received(imaging_dataframe) function takes the imaging log data frame and lengthens the
     table to convert the scan into a variable while preserving columns for the indicated and received value of each scan.
     Validation columns parameter should be a lits of tuples where the first tuple value is the column name and the
-    second entry is the value of 'Y' for that column"""
-    df = imaging_dataframe.copy()
+    second entry is the value of 'Y' for that column. Overdue scans are found as of reference_date (default today),
+    with v3_window days allowed for V3 scans after surgery."""
+    df = imaging_dataframe
 
-    # Select columns, and create long dataframes from those columns, pivoting the scan into a variable
-    # Select and pivot indicated columns
+    # Select columns, and create a long dataframe from those columns, pivoting the scan into a variable
     index_cols = ['site','subject_id','visit','acquisition_week','Surgery Week','bids_validation', 'dicom']
     index_new = ['Site', 'Subject', 'Visit','Acquisition Week','Surgery Week', 'BIDS','DICOM']
 
@@ -118,45 +1033,196 @@ def get_indicated_received(imaging_dataframe, validation_column = 'bids_validati
 
     scan_cols_short = ['T1','DWI','CUFF1','CUFF2','REST1','REST2']
 
-    indicated = df[index_cols + indicated_cols]
-    indicated.columns = index_cols + scan_cols_short
-    indicated = pd.melt(indicated, id_vars=index_cols, value_vars = scan_cols_short)
-    indicated.columns = index_new + ['Scan', 'Value']
+    # Convert the dates once per record, before the records are repeated for each scan
+    records = df[index_cols]
+    records.columns = index_new
+    surgery_week = as_datetime(records['Surgery Week'])
+    records = records.assign(**{'Surgery Week': surgery_week.dt.date,
+                                'Acquisition Week': as_datetime(records['Acquisition Week']).dt.date})
 
-    # Select and pivot received_cols columns
-    received_cols = ['T1 Received',
-       'DWI Received',
-       'fMRI Individualized Pressure Received',
-       'fMRI Standard Pressure Received',
-       '1st Resting State Received',
-       '2nd Resting State Received']
+    # Reshape to one row per record and scan in a single step, scan by scan like pd.melt, with the
+    # indicated and received values of a scan side by side
+    n = len(df)
+    rows = np.tile(np.arange(n), len(scan_cols_short))
+    combined = records.take(rows)
+    combined.index = pd.RangeIndex(len(combined))
+    combined['Scan'] = np.repeat(scan_cols_short, n).astype(object)
+    combined['Indicated'] = df[indicated_cols].to_numpy().ravel(order='F')
+    combined['Received'] = df[received_cols].to_numpy().ravel(order='F')
 
-    received = df[index_cols + received_cols]
-    received.columns = index_cols + scan_cols_short
-    received = pd.melt(received, id_vars=index_cols, value_vars = scan_cols_short)
-    received.columns = index_new + ['Scan', 'Value']
+    # Calculate if overdue
+    combined['Overdue'] = calculate_overdue(combined['BIDS'], combined['Visit'], surgery_week.take(rows),
+                                            reference_date, v3_window)
 
-    # Merge the indicated and received dataframes into a single dataframe
-    merge_on = index_new + ['Scan']
-    combined = pd.merge(indicated, received, how='outer', on=index_new + ['Scan'] )
-    combined.columns = index_new + ['Scan','Indicated','Received']
+    return combined
 
-    # Convert columns to dates and calculate if overdue
-    combined['Surgery Week'] = pd.to_datetime(combined['Surgery Week'], errors='coerce').dt.date
-    combined['Acquisition Week'] = pd.to_datetime(combined['Acquisition Week'], errors='coerce').dt.date
-    combined['Overdue'] = combined.apply(lambda x: calculate_overdue(x['BIDS'], x['Visit'], x['Surgery Week']), axis=1)
 
-    return combined
 
+# ----------------------------------------------------------------------------
+# Table paging
+# ----------------------------------------------------------------------------
+# DataTables with page_action, filter_action and sort_action set to 'custom' only receive the rows of
+# the page on screen. Their filter_query is translated here into a vectorized mask over the table.
+# Conditions are joined with &&, as the column filter cells write them. Relational operators take an
+# i (case-insensitive) or s (case-sensitive) prefix; missing values never match, except for ne.
+# Queries using anything else (|| or parentheses, for example) are rejected with a ValueError.
+filter_condition = re.compile(r"""\{(?P<col>(?:[^{}\\]|\\.)+)\}\s*(?:
+    (?P<unary>is\s+(?:not\s+)?(?:blank|bool|even|nil|num|object|odd|str))
+    |(?P<op>[is]?(?:<=|>=|!=|<|>|=)|[is]?(?:eq|ne|lt|le|gt|ge|contains|datestartswith)(?=\s))\s*
+     (?P<value>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`(?:[^`\\]|\\.)*`|[^\s'"`{}()]+))""", re.X | re.I)
+filter_operator_names = {'=': 'eq', '!=': 'ne', '<': 'lt', '<=': 'le', '>': 'gt', '>=': 'ge'}
+filter_comparisons = ['eq', 'ne', 'lt', 'le', 'gt', 'ge']
+
+def split_filter_query(filter_query):
+    '''Split a DataTable filter_query into its && separated conditions, keeping quoted values whole'''
+    parts = []
+    start = 0
+    quote = None
+    i = 0
+    while i < len(filter_query):
+        char = filter_query[i]
+        if quote:
+            if char == '\\':
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char in '\'"`':
+            quote = char
+        elif filter_query.startswith('&&', i):
+            parts.append(filter_query[start:i])
+            start = i + 2
+            i += 1
+        i += 1
+    parts.append(filter_query[start:])
+    return [part.strip() for part in parts if part.strip()]
+
+def split_filter_part(filter_part):
+    '''Split one condition of a DataTable filter_query into (column, operator, value text). Unary
+    operators such as 'is blank' have no value; unsupported conditions raise a ValueError.'''
+    match = filter_condition.fullmatch(filter_part)
+    if match is None:
+        raise ValueError('Unsupported filter condition: ' + filter_part)
+    col = re.sub(r'\\(.)', r'\1', match.group('col'))
+    if match.group('unary'):
+        return col, ' '.join(match.group('unary').lower().split()), None
+    value = match.group('value')
+    if value[0] in '\'"`':
+        value = re.sub(r'\\(.)', r'\1', value[1:-1])
+    return col, match.group('op').lower(), value
+
+def get_filter_text(series, case_insensitive=False):
+    '''Return the column as the text shown in the table (dates as YYYY-MM-DD), lower case if case_insensitive'''
+    if pd.api.types.is_datetime64_any_dtype(series):
+        text = series.dt.strftime('%Y-%m-%d')
+    else:
+        text = series.astype(str)
+    return text.str.lower() if case_insensitive else text
+
+def get_filter_dates(series):
+    '''Return the column as datetimes if it holds dates (datetime64 values or date objects), else None'''
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    if series.dtype == object:
+        values = series.dropna()
+        if len(values) and isinstance(values.iloc[0], date):
+            return pd.to_datetime(series)
+    return None
+
+def get_unary_mask(series, op):
+    '''Return the rows of the column matching a unary filter operator such as 'is blank' or 'is not num'.
+    Values are typed as the table receives them, where dates are text.'''
+    notna = series.notna().to_numpy()
+    kind = op.split()[-1]
+    if kind == 'nil':
+        mask = ~notna
+    elif kind == 'blank':
+        mask = ~notna | (get_filter_text(series) == '').to_numpy()
+    elif pd.api.types.is_bool_dtype(series):
+        mask = notna & (kind == 'bool')
+    elif pd.api.types.is_numeric_dtype(series):
+        if kind == 'even':
+            mask = notna & (series % 2 == 0).to_numpy()
+        elif kind == 'odd':
+            mask = notna & (series % 2 == 1).to_numpy()
+        else:
+            mask = notna & (kind == 'num')
+    else:
+        # Text, category and date columns
+        mask = notna & (kind == 'str')
+    return ~mask if ' not ' in op else mask
 
+def get_condition_mask(series, op, text):
+    '''Return the rows of the column matching one relational filter condition'''
+    notna = series.notna().to_numpy()
+    case_insensitive = False
+    if op[:1] in ['i', 's'] and op[1:] in filter_comparisons + list(filter_operator_names) + ['contains', 'datestartswith']:
+        case_insensitive = op[0] == 'i'
+        op = op[1:]
+    op = filter_operator_names.get(op, op)
+    if op in filter_comparisons:
+        values = get_filter_dates(series)
+        if values is not None:
+            value = pd.Timestamp(text)
+        elif pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+            try:
+                values, value = series, float(text)
+            except ValueError:
+                pass
+        if values is None:
+            values = get_filter_text(series, case_insensitive)
+            value = text.lower() if case_insensitive else text
+        mask = getattr(operator, op)(values, value).to_numpy() & notna
+        if op == 'ne':
+            mask |= ~notna
+        return mask
+    values = get_filter_text(series, case_insensitive)
+    value = text.lower() if case_insensitive else text
+    if op == 'contains':
+        return values.str.contains(value, regex=False).to_numpy(dtype=bool, na_value=False) & notna
+    return values.str.startswith(value).to_numpy(dtype=bool, na_value=False) & notna
+
+def get_filter_mask(df, filter_query):
+    '''Return a boolean array selecting the rows of df that match a DataTable filter_query. Raises a
+    ValueError for conditions that are not supported or name a column df does not have.'''
+    mask = np.ones(len(df), dtype=bool)
+    if not filter_query:
+        return mask
+    for filter_part in split_filter_query(filter_query):
+        col, op, text = split_filter_part(filter_part)
+        if col not in df.columns:
+            raise ValueError('Unknown filter column: ' + col)
+        if text is None:
+            mask &= get_unary_mask(df[col], op)
+        else:
+            mask &= get_condition_mask(df[col], op, text)
+    return mask
+
+def get_table_page(df, page_current=0, page_size=25, sort_by=None, filter_query=''):
+    '''Filter and sort df like a DataTable and return the records of the requested page with the
+    number of pages and the page shown, which is the last page if the requested one is past it'''
+    view = df[get_filter_mask(df, filter_query)]
+    if sort_by:
+        view = view.sort_values([col['column_id'] for col in sort_by],
+                                ascending=[col['direction'] == 'asc' for col in sort_by], kind='mergesort')
+    page_count = max(1, math.ceil(len(view) / page_size))
+    page_current = min(page_current or 0, page_count - 1)
+    page = view.iloc[page_current * page_size: (page_current + 1) * page_size]
+    return frame_to_records(page), page_count, page_current
 
 # ----------------------------------------------------------------------------
 # Imaging Overview
 # ----------------------------------------------------------------------------
 def roll_up(imaging):
     cols = ['site','visit','subject_id']
-    df = imaging[cols].groupby(['site','visit']).count().reset_index()
-    df = df.pivot(index='site', columns = 'visit', values = 'subject_id')
+    # Use plain text keys so the 'All Sites' row and 'Total' column can be added to the pivot
+    df = imaging[cols].astype({'site': 'object', 'visit': 'object'})
+    df = df.groupby(['site','visit']).count().reset_index()
+    return roll_up_counts(df)
+
+def roll_up_counts(counts):
+    '''Pivot the subject_id counts by site and visit (one row per site and visit, sorted) into the
+    overview table'''
+    df = counts.pivot(index='site', columns = 'visit', values = 'subject_id')
     df.loc['All Sites'] = df.sum(numeric_only=True, axis=0)
     df.loc[:,'Total'] = df.sum(numeric_only=True, axis=1)
     df.reset_index(inplace=True)
@@ -165,81 +1231,200 @@ def roll_up(imaging):
 # ----------------------------------------------------------------------------
 # Completions
 # ----------------------------------------------------------------------------
-def get_completions(df):
-    scan_dict = {'T1 Indicated':'T1',
-       'DWI Indicated':'DWI',
-       '1st Resting State Indicated':'REST1',
-       'fMRI Individualized Pressure Indicated':'CUFF1',
-       'fMRI Standard Pressure Indicated':'CUFF2',
-       '2nd Resting State Indicated':'REST2'}
+# Indicated scan columns of the completions and their short names, in acquisition order
+completions_scan_dict = {'T1 Indicated':'T1',
+   'DWI Indicated':'DWI',
+   '1st Resting State Indicated':'REST1',
+   'fMRI Individualized Pressure Indicated':'CUFF1',
+   'fMRI Standard Pressure Indicated':'CUFF2',
+   '2nd Resting State Indicated':'REST2'}
 
-    icols = list(scan_dict.keys())
-    icols2 = list(scan_dict.values())
+def get_completions(df):
+    icols = list(completions_scan_dict.keys())
 
-    df['completions_id'] = df.apply(lambda x: str(x['subject_id']) + x['visit'],axis=1)
-    completions = df[['completions_id']+icols].groupby(icols).count().reset_index().rename(columns=scan_dict).rename(columns={'completions_id':'Count'})
+    df = df.assign(completions_id = df.apply(lambda x: str(x['subject_id']) + x['visit'],axis=1))
+    completions = df[['completions_id']+icols].groupby(icols).count().reset_index().rename(columns=completions_scan_dict).rename(columns={'completions_id':'Count'})
     completions['Percent'] = round(100 * completions['Count']/(completions['Count'].sum()),1)
     completions = completions.sort_values(by=['Count'], ascending=False)
     completions.loc[:, ~completions.columns.isin(['Count', 'Percent'])] = completions.loc[:, ~completions.columns.isin(['Count', 'Percent'])].replace([0,1],['N','Y'])
 
     return completions
 
-def completions_label_site(imaging, site, sites_info):
-    # Get completions data for data subset
-    if site == 'ALL':
-        df = imaging.copy()
-    elif site == 'MCC1':
-        df = imaging[imaging['site'].isin(list(sites_info[sites_info['mcc']==1].site))].copy()
-    elif site == 'MCC2':
-        df = imaging[imaging['site'].isin(list(sites_info[sites_info['mcc']==2].site))].copy()
+def get_label_counts(counts, label, sites_info):
+    '''Sum the scan pattern counts by site (columns of counts) for label: 'ALL', 'MCC1', 'MCC2' or a site'''
+    if label == 'ALL':
+        return counts.sum(axis=1)
+    elif label in ['MCC1', 'MCC2']:
+        label_sites = list(sites_info[sites_info['mcc']==int(label[-1])].site)
     else:
-        df = imaging[imaging['site'] == site].copy()
-    completions = get_completions(df)
-
-    # Convert to multi-index
-    multi_col = []
-    for col in completions.columns[0:6]:
-        t = ('Scan', col)
-        multi_col.append(t)
-    for col in completions.columns[6:]:
-        t = (site, col)
-        multi_col.append(t)
-    completions.columns = multi_col
+        label_sites = [label]
+    return counts[[site for site in label_sites if site in counts.columns]].sum(axis=1)
 
-    return completions
+def get_completion_counts(imaging):
+    '''Count the sessions by scan pattern (rows) and site (columns). Sessions without a site are only
+    counted in 'ALL', under column -1.'''
+    icols = list(completions_scan_dict.keys())
+    df = imaging.dropna(subset=icols)
+    codes, sites = pd.factorize(df['site'].astype(object))
+    counts = df[icols].assign(site_code=codes).groupby(icols + ['site_code']).size().unstack('site_code', fill_value=0)
+    return counts.rename(columns=dict(enumerate(sites)))
+
+def merge_completion_counts(sites_list, counts, sites_info):
+    '''Return the completions of each label in sites_list ('ALL', 'MCC1', 'MCC2' or a site) side by side,
+    with ('Scan', scan) columns for the scan pattern and (label, 'Count') and (label, 'Percent') columns,
+    in the row order of the first label. counts are the session counts by scan pattern and site (see
+    get_completion_counts); the label counts are sums of the site counts. Patterns without sessions
+    are left out.'''
+    scan_dict = completions_scan_dict
+    icols = list(scan_dict.keys())
+    icols2 = list(scan_dict.values())
 
-def merge_completions(sites_list, imaging, sites_info):
-    c = completions_label_site(imaging, sites_list[0], sites_info)
-    for site in sites_list[1:]:
-        c_site = completions_label_site(imaging, site, sites_info)
-        c = c.merge(c_site, how='left', on=list(c.columns[0:6]))
-    c = c.dropna(axis='columns', how='all').fillna(0)
-    return c
+    # Rows of the first label, ordered like get_completions
+    first = get_label_counts(counts, sites_list[0], sites_info)
+    completions = first[first > 0].rename('Count').reset_index().rename(columns=scan_dict)
+    completions['Percent'] = round(100 * completions['Count']/(completions['Count'].sum()),1)
+    completions = completions.sort_values(by=['Count'], ascending=False)
+    completions[icols2] = completions[icols2].replace([0,1],['N','Y'])
+    patterns = pd.MultiIndex.from_frame(first[first > 0].reset_index()[icols]).take(completions.index)
+
+    columns = {('Scan', col): completions[col].to_numpy() for col in icols2}
+    columns[(sites_list[0], 'Count')] = completions['Count'].to_numpy()
+    columns[(sites_list[0], 'Percent')] = completions['Percent'].to_numpy()
+    for label in sites_list[1:]:
+        label_counts = get_label_counts(counts, label, sites_info)
+        count = label_counts.reindex(patterns).to_numpy()
+        count = np.where(np.isnan(count), 0, count) if count.dtype.kind == 'f' else count
+        if not label_counts.any() or not (count > 0).any():
+            # A label without sessions has no columns
+            continue
+        percent = np.round(100 * count / label_counts.sum(), 1)
+        if (count == 0).any():
+            # Patterns missing from the label were filled with 0 after a merge, as floats
+            count = count.astype(float)
+        columns[(label, 'Count')] = count
+        columns[(label, 'Percent')] = percent
+    return pd.DataFrame(columns)
 
 # ----------------------------------------------------------------------------
 # Heat matrix
 # ----------------------------------------------------------------------------
 
-def get_heat_matrix_df(qc, site, color_mapping_list):
-    color_mapping_df = pd.DataFrame(color_mapping_list)
-    color_mapping_df.columns= ['value','color']
-    qc_cols = ['sub','ses', 'scan','rating']
-    q = qc[(qc.site == site)][qc_cols]
-    if len(q) >0:
-        q['sub'] = q['sub'].astype(str)
-        q2 = q.merge(color_mapping_df, how='left', left_on='rating', right_on='color')
-        q3 = q2.sort_values(['sub','ses','scan']).drop_duplicates(['sub','ses','scan'],keep='last')
-        q3['Scan'] = q3['ses'] + '-' + q3['scan']
-        q3_matrix = q3.pivot(index='sub', columns = 'Scan', values = 'value').fillna(0)
-        q3_matrix_cols = ['V1-T1', 'V1-CUFF1', 'V1-CUFF2', 'V1-REST1', 'V1-REST2',
-                 'V3-T1', 'V3-CUFF1', 'V3-CUFF2', 'V3-REST1', 'V3-REST2']
-        matrix_df = q3_matrix[q3_matrix_cols]
+color_mapping_list = [(0.0, 'white'),(0.1, 'lightgrey'),(0.25, 'red'),(0.5, 'orange'),(0.75, 'yellow'),(1.0, 'green')]
+
+# Columns of the heat matrix, by visit and scan
+heat_matrix_cols = ['V1-T1', 'V1-CUFF1', 'V1-CUFF2', 'V1-REST1', 'V1-REST2',
+                    'V3-T1', 'V3-CUFF1', 'V3-CUFF2', 'V3-REST1', 'V3-REST2']
+
+def get_heat_ratings(qc, color_mapping_list):
+    '''Return the last rating of each site, subject, visit and scan of the qc records, grouped by site:
+    the positions of the records ('rows'), their subject codes in text order ('subs'), heat matrix
+    columns ('cols', -1 for visits and scans that are not shown) and values ('values', 0 for unknown
+    ratings), with the sites, the start of each site's ratings and the subjects as text'''
+    # Rate each record through a lookup on the rating categories; unknown ratings are NaN
+    rating = pd.Categorical(qc['rating'])
+    color_values = {color: value for value, color in color_mapping_list}
+    rating_values = np.append(pd.Series(rating.categories).map(color_values).to_numpy(dtype=float), np.nan)
+    values = rating_values[rating.codes]
+
+    # Integer codes of the site, subject (in text order), visit and scan of each record, with missing
+    # visits and scans coded 0
+    site_codes, sites = pd.factorize(qc['site'])
+    sub_codes, subs = pd.factorize(qc['sub'])
+    subs = pd.Index(subs).astype(str)
+    sub_order = np.argsort(subs.to_numpy(), kind='stable')
+    sub_codes, subs = np.argsort(sub_order)[sub_codes], subs.take(sub_order)
+    ses_codes, ses_values = pd.factorize(qc['ses'])
+    scan_codes, scan_values = pd.factorize(qc['scan'])
+    ses_codes, scan_codes = ses_codes + 1, scan_codes + 1
+    n_scans = len(scan_values) + 1
+
+    # Keep the last record of each site, subject, visit and scan
+    scan_keys = ses_codes * n_scans + scan_codes
+    keys = (site_codes * len(subs) + sub_codes) * ((len(ses_values) + 1) * n_scans) + scan_keys
+    last = pd.Series(np.arange(len(qc))).groupby(keys).last().to_numpy()
+    last = last[site_codes[last] >= 0]
+    last = last[np.argsort(site_codes[last], kind='stable')]
+
+    # Matrix column of each visit and scan, or -1 for the visits and scans that are not shown
+    labels = [str(ses) + '-' + str(scan) for ses in ['nan'] + list(ses_values) for scan in ['nan'] + list(scan_values)]
+    scan_cols = np.array([heat_matrix_cols.index(label) if label in heat_matrix_cols else -1 for label in labels])
+
+    return {
+        'sites': list(sites),
+        'site_starts': np.searchsorted(site_codes[last], np.arange(len(sites) + 1)),
+        'rows': last,
+        'subs': sub_codes[last],
+        'cols': scan_cols[scan_keys[last]],
+        'values': np.nan_to_num(values[last]),
+        'sub_text': subs,
+    }
+
+def get_heat_matrices(qc, color_mapping_list):
+    '''Return the heat matrix of each site of the qc records: the value of the last rating of each visit and
+    scan (columns) of each subject (rows, sorted as text), with 0 for scans without a known rating, and a
+    blank column between the visits'''
+    if qc.empty:
+        return {}
+    ratings = get_heat_ratings(qc, color_mapping_list)
+
+    matrices = {}
+    for code, site in enumerate(ratings['sites']):
+        site_ratings = slice(ratings['site_starts'][code], ratings['site_starts'][code + 1])
+        site_subs, sub_rows = np.unique(ratings['subs'][site_ratings], return_inverse=True)
+        cols = ratings['cols'][site_ratings]
+        shown = cols >= 0
+        matrix = np.zeros((len(site_subs), len(heat_matrix_cols)))
+        matrix[sub_rows[shown], cols[shown]] = ratings['values'][site_ratings][shown]
+        matrix_df = pd.DataFrame(matrix, index=ratings['sub_text'].take(site_subs), columns=heat_matrix_cols)
         matrix_df.insert(5, "", [0.1] * len(matrix_df))
-        matrix_df.columns.name = None
-        matrix_df.index.name = None
-    else:
-        matrix_df = pd.DataFrame()
-    return matrix_df
+        matrices[site] = matrix_df
+    return matrices
+
+def get_heat_strips(qc, imaging, color_mapping_list):
+    '''Return the heat strip of each site of the qc records: the mean value of the last ratings of each
+    visit and scan (rows, as in the heat matrix) by the acquisition week of their session (columns).
+    Its size depends on the weeks, not on the number of subjects.'''
+    if qc.empty:
+        return {}
+    ratings = get_heat_ratings(qc, color_mapping_list)
+
+    # Acquisition week of each rating, from the imaging record of its subject and visit
+    qc_keys = get_qc_keys(qc)
+    imaging_keys = get_visit_keys(imaging['subject_id'], imaging['visit'], qc_keys['visits'])
+    first = (imaging_keys >= 0) & ~pd.Index(imaging_keys).duplicated()
+    sessions = pd.Index(imaging_keys[first]).get_indexer(qc_keys['keys'][ratings['rows']])
+    imaging_weeks = as_datetime(imaging['acquisition_week']).to_numpy()[first]
+    weeks = np.where(sessions >= 0, imaging_weeks[sessions], np.datetime64('NaT'))
+
+    shown = (ratings['cols'] >= 0) & ~np.isnat(weeks)
+    site_codes = np.repeat(np.arange(len(ratings['sites'])), np.diff(ratings['site_starts']))
+    means = pd.DataFrame({'site': site_codes[shown], 'col': ratings['cols'][shown], 'week': weeks[shown],
+                          'value': ratings['values'][shown]}).groupby(['site', 'col', 'week'])['value'].mean()
+
+    strips = {}
+    for code, site in enumerate(ratings['sites']):
+        if code not in means.index.get_level_values('site'):
+            continue
+        strip = means.loc[code].unstack('week').reindex(range(len(heat_matrix_cols)))
+        strip.index = heat_matrix_cols
+        strip.columns = strip.columns.strftime('%Y-%m-%d')
+        strip.index.name = strip.columns.name = None
+        strip.loc[""] = 0.1
+        strips[site] = strip.reindex(heat_matrix_cols[:5] + [""] + heat_matrix_cols[5:])
+    return strips
+
+# Dimensions of the qc count cube
+count_cube_dims = ['site', 'mcc', 'ses', 'scan', 'rating']
+
+def get_count_cube(qc, mcc_dict, count_col='sub', dims=count_cube_dims):
+    '''Count the count_col values of the qc records for every observed combination of the dims columns,
+    including missing values. Counts for any coarser grouping are the sums of the cube's counts. The
+    dims columns are plain values rather than categoricals, so a date window's cube only carries the
+    categories it observed (plotly fails on unobserved ones).'''
+    df = qc.merge(pd.DataFrame(mcc_dict), how='left', on='site')
+    cube = df[dims + [count_col]].groupby(dims, observed=True, dropna=False)[count_col].count().reset_index()
+    categorical = [col for col in dims if pd.api.types.is_categorical_dtype(cube[col])]
+    return cube.astype({col: object for col in categorical})
 
 def get_stacked_bar_data(df, id_col, metric_col, cat_cols, count_col = None):
     if count_col:
@@ -248,8 +1433,330 @@ def get_stacked_bar_data(df, id_col, metric_col, cat_cols, count_col = None):
         count_col = 'count'
         sb = df[cat_cols + [metric_col, id_col]].copy()
         sb[count_col] = 1
-    sb_grouped = sb[cat_cols+[metric_col, count_col]].groupby(cat_cols+[metric_col]).count()
+    sb_grouped = sb[cat_cols+[metric_col, count_col]].groupby(cat_cols+[metric_col], observed=True).count()
     sb_grouped.reset_index(inplace=True)
-    sb_grouped['Total N'] = sb_grouped.groupby(cat_cols)[count_col].transform('sum')
+    sb_grouped['Total N'] = sb_grouped.groupby(cat_cols, observed=True)[count_col].transform('sum')
     sb_grouped['%'] = 100 * sb_grouped[count_col] / sb_grouped['Total N']
     return sb_grouped
+
+# ----------------------------------------------------------------------------
+# Box plot statistics
+# ----------------------------------------------------------------------------
+def interpolate_sorted(values, starts, counts, p):
+    '''Return the p quantile of each group of sorted values (starting at starts, with counts values), with
+    plotly's default 'linear' quartile method'''
+    position = np.clip(p * counts - 0.5, 0, counts - 1)
+    low, high = np.floor(position).astype(int), np.ceil(position).astype(int)
+    fraction = position % 1
+    return fraction * values[starts + high] + (1 - fraction) * values[starts + low]
+
+def get_box_stats(df, value_col, group_cols):
+    '''Return the box plot statistics of value_col for each group of group_cols, in order of first appearance,
+    as plotly computes them from the sample values: the number of records and of values, the quartiles,
+    the fences (the furthest values within 1.5 IQR of the box) and the distinct outlier values beyond them.
+    Groups without values have NaN statistics.'''
+    groups = df.groupby(group_cols, observed=True, sort=False)
+    stats = groups.size().rename('records').reset_index()
+    codes = groups.ngroup().to_numpy()
+    values = df[value_col].to_numpy(dtype=float)
+    # Records with a missing group column are not in any group
+    has_value = ~np.isnan(values) & (codes >= 0)
+    codes, values = codes[has_value].astype(int), values[has_value]
+    order = np.lexsort((values, codes))
+    codes, values = codes[order], values[order]
+
+    counts = np.bincount(codes, minlength=len(stats))
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    has_values = counts > 0
+    stats['values'] = counts
+    for col in ['q1', 'median', 'q3', 'lowerfence', 'upperfence']:
+        stats[col] = np.nan
+    stats['outliers'] = [[] for i in range(len(stats))]
+    if not has_values.any():
+        return stats
+    starts, counts = starts[has_values], counts[has_values]
+    q1 = interpolate_sorted(values, starts, counts, 0.25)
+    median = interpolate_sorted(values, starts, counts, 0.5)
+    q3 = interpolate_sorted(values, starts, counts, 0.75)
+
+    # Fences: the first value from 2.5 q1 - 1.5 q3 and the last value up to 2.5 q3 - 1.5 q1
+    box = np.cumsum(has_values) - 1
+    lower, upper = (2.5 * q1 - 1.5 * q3)[box[codes]], (2.5 * q3 - 1.5 * q1)[box[codes]]
+    below = np.bincount(codes, weights=values < lower, minlength=len(stats))[has_values].astype(int)
+    within = np.bincount(codes, weights=values <= upper, minlength=len(stats))[has_values].astype(int)
+    lowerfence = np.minimum(q1, values[starts + np.minimum(below, counts - 1)])
+    upperfence = np.maximum(q3, values[starts + np.maximum(within - 1, 0)])
+
+    # Outliers with the same value are drawn on top of each other, so each value is kept once
+    outlier = (values < lowerfence[box[codes]]) | (values > upperfence[box[codes]])
+    outliers = pd.Series(values[outlier]).groupby(codes[outlier]).unique()
+    stats.loc[has_values, ['q1', 'median', 'q3', 'lowerfence', 'upperfence']] = np.column_stack(
+        [q1, median, q3, lowerfence, upperfence])
+    stats['outliers'] = [list(outliers.get(code, [])) for code in range(len(stats))]
+    return stats
+
+# ----------------------------------------------------------------------------
+# DATE RANGE INDEX
+# ----------------------------------------------------------------------------
+# Report windows are served from an index of the imaging records built once per snapshot: the record
+# positions sorted by acquisition week, and the cumulative counts by week of the records of each site
+# and visit (for the overview) and of each scan pattern and site (for the completions). Weeks are
+# numbered in date order, with the records without an acquisition week in a last bucket. A window is
+# a range of week buckets found by binary search; its records are a slice of the sorted positions and
+# its counts the difference of two rows of the cumulative counts.
+def get_cumulative_counts(week_codes, group_codes, n_weeks, n_groups):
+    '''Return the cumulative counts by week of the records of each group, with a row of zeros first: row k
+    holds the counts of the records in the weeks before k. Records with a group code of -1 are not counted.'''
+    counted = group_codes >= 0
+    counts = np.bincount(week_codes[counted] * n_groups + group_codes[counted], minlength=n_weeks * n_groups)
+    cumulative = np.zeros((n_weeks + 1, n_groups), dtype=np.int64)
+    np.cumsum(counts.reshape(n_weeks, n_groups), axis=0, out=cumulative[1:])
+    return cumulative
+
+def get_date_index(imaging):
+    '''Return the date range index of the imaging records'''
+    acquisition_week = as_datetime(imaging['acquisition_week']).to_numpy()
+    has_week = ~np.isnat(acquisition_week)
+    weeks = np.unique(acquisition_week[has_week])
+    week_codes = np.where(has_week, np.searchsorted(weeks, acquisition_week), len(weeks))
+    order = np.argsort(week_codes, kind='stable')
+    week_starts = np.searchsorted(week_codes[order], np.arange(len(weeks) + 2))
+
+    # Overview: records and subjects by site and visit, sorted like the roll_up groupby
+    site_codes, site_values = pd.factorize(imaging['site'].astype(object), sort=True)
+    visit_codes, visit_values = pd.factorize(imaging['visit'].astype(object), sort=True)
+    overview_codes = np.where((site_codes >= 0) & (visit_codes >= 0), site_codes * len(visit_values) + visit_codes, -1)
+    subject_codes = np.where(imaging['subject_id'].notna().to_numpy(), overview_codes, -1)
+    overview_keys = pd.DataFrame({'site': np.repeat(np.asarray(site_values, dtype=object), len(visit_values)),
+                                  'visit': np.tile(np.asarray(visit_values, dtype=object), len(site_values))})
+
+    # Completions: sessions by scan pattern and site, like get_completion_counts
+    icols = list(completions_scan_dict.keys())
+    has_pattern = imaging[icols].notna().all(axis=1).to_numpy()
+    patterns = imaging.loc[has_pattern, icols].groupby(icols)
+    pattern_codes = np.full(len(imaging), -1)
+    pattern_codes[has_pattern] = patterns.ngroup().to_numpy()
+    completion_sites, completion_site_values = pd.factorize(imaging['site'].astype(object))
+    completion_sites = np.where(completion_sites >= 0, completion_sites, len(completion_site_values))
+    n_sites = len(completion_site_values) + 1
+    completion_codes = np.where(pattern_codes >= 0, pattern_codes * n_sites + completion_sites, -1)
+
+    n_weeks = len(weeks) + 1
+    return {
+        'weeks': weeks,
+        'acquisition_week': acquisition_week,
+        'order': order,
+        'week_starts': week_starts,
+        'overview_keys': overview_keys,
+        'overview_records': get_cumulative_counts(week_codes, overview_codes, n_weeks, len(overview_keys)),
+        'overview_subjects': get_cumulative_counts(week_codes, subject_codes, n_weeks, len(overview_keys)),
+        'patterns': patterns.size().index,
+        'completion_sites': list(completion_site_values) + [-1],
+        'completion_counts': get_cumulative_counts(week_codes, completion_codes, n_weeks, patterns.ngroups * n_sites),
+    }
+
+def get_date_window(date_index, start_date=None, end_date=None):
+    '''Return the first and last + 1 week buckets of the records acquired from start_date to end_date, as
+    filter_imaging selects them. Records without an acquisition week are only in the window without dates.'''
+    weeks = date_index['weeks']
+    if start_date is None and end_date is None:
+        return 0, len(weeks) + 1
+    first = np.searchsorted(weeks, pd.Timestamp(start_date).to_datetime64(), 'left') if start_date is not None else 0
+    last = np.searchsorted(weeks, pd.Timestamp(end_date).to_datetime64(), 'right') if end_date is not None else len(weeks)
+    return int(first), int(max(first, last))
+
+def get_window_rows(date_index, window):
+    '''Return the positions of the imaging records in the window, in record order'''
+    week_starts = date_index['week_starts']
+    return np.sort(date_index['order'][week_starts[window[0]]:week_starts[window[1]]])
+
+def get_window_counts(date_index, name, window):
+    '''Return the counts of the window from the cumulative counts name of the date index'''
+    cumulative = date_index[name]
+    return cumulative[window[1]] - cumulative[window[0]]
+
+def get_window_overview(date_index, window):
+    '''Return roll_up of the imaging records in the window'''
+    records = get_window_counts(date_index, 'overview_records', window)
+    subjects = get_window_counts(date_index, 'overview_subjects', window)
+    counts = date_index['overview_keys'][records > 0].assign(subject_id=subjects[records > 0])
+    return roll_up_counts(counts.reset_index(drop=True))
+
+def get_window_completion_counts(date_index, window):
+    '''Return get_completion_counts of the imaging records in the window, with all the scan patterns and
+    sites of the snapshot'''
+    patterns = date_index['patterns']
+    counts = get_window_counts(date_index, 'completion_counts', window).reshape(len(patterns), -1)
+    return pd.DataFrame(counts, index=patterns, columns=date_index['completion_sites'])
+
+# ----------------------------------------------------------------------------
+# DERIVED TABLES
+# ----------------------------------------------------------------------------
+# The report tables form a small dependency graph. Each derived table is registered with the tables it
+# is computed from, and is only computed the first time a callback asks for it. Computed tables are
+# kept in a table set: one per snapshot for the unfiltered report, and one per snapshot and date filter
+# in an LRU cache. Tables in a set are shared by all callbacks and must not be modified.
+derived_tables = {}
+derived_table_timings = {}
+
+# Building plotly figures in several threads at once corrupts them (plotly raises 'Invalid value'), so
+# figure tables are built one at a time
+figure_lock = threading.Lock()
+
+def derived_table(name, *inputs, empty=pd.DataFrame, figure=False):
+    '''Decorator registering a function as the derived table name, computed from the named input tables
+    (and any parameters given to get_table). empty builds the table when there is no data. figure is
+    True for tables that are plotly figures.'''
+    def register(function):
+        derived_tables[name] = {'inputs': list(inputs), 'function': function, 'empty': empty, 'figure': figure}
+        return function
+    return register
+
+def make_table_set(imaging, qc, start_date=None, end_date=None):
+    '''Return a new table set for the imaging and qc data filtered by the start and end dates'''
+    return {
+        'tables': {'source_imaging': imaging, 'source_qc': qc, 'start_date': start_date, 'end_date': end_date,
+                   'reference_date': date.today()},
+        'empty': imaging.empty or qc.empty,
+        'lock': threading.Lock(),
+        'table_locks': {},
+        'cache': None,
+        'cache_key': None,
+    }
+
+def is_table_set_current(table_set):
+    '''Return True if the table set was made today; overdue scans are found as of that day'''
+    return table_set['tables']['reference_date'] == date.today()
+
+def get_table(table_set, name, *params):
+    '''Return the table name of the table set, computing it and any missing inputs first'''
+    key = (name,) + params if params else name
+    tables = table_set['tables']
+    if key in tables:
+        return tables[key]
+    node = derived_tables[name]
+    # Each table has its own lock, so different tables of a set can be computed in parallel
+    with table_set['lock']:
+        table_lock = table_set['table_locks'].setdefault(key, threading.Lock())
+    with table_lock:
+        if key in tables:
+            return tables[key]
+        if table_set['empty']:
+            value = node['empty']()
+        else:
+            inputs = [get_table(table_set, input_name) for input_name in node['inputs']]
+            start = time.perf_counter()
+            if node['figure']:
+                with figure_lock:
+                    value = node['function'](*inputs, *params)
+            else:
+                value = node['function'](*inputs, *params)
+            seconds = time.perf_counter() - start
+            timing = derived_table_timings.setdefault(name, {'calls': 0, 'seconds': 0.0, 'last': 0.0})
+            timing.update(calls=timing['calls'] + 1, seconds=timing['seconds'] + seconds, last=seconds)
+        tables[key] = value
+    if table_set['cache'] is not None:
+        lru_add_bytes(table_set['cache'], table_set['cache_key'], get_value_bytes(value))
+    return value
+
+# The date index and qc keys are built once per snapshot and shared with its date filtered table sets
+shared_tables = ['date_index', 'qc_keys']
+
+derived_table('date_index', 'source_imaging', empty=dict)(get_date_index)
+derived_table('date_window', 'date_index', 'start_date', 'end_date', empty=tuple)(get_date_window)
+
+@derived_table('imaging', 'source_imaging', 'date_index', 'date_window')
+def get_filtered_imaging(imaging, date_index, window):
+    '''filter_imaging, taking the records of the window from the date index'''
+    rows = get_window_rows(date_index, window)
+    if len(rows) == len(imaging):
+        # The whole log (the report without dates): keep the (shared, mapped) frame rather than copy it.
+        # Its acquisition_week is already typed as dates by the imaging schema.
+        return imaging
+    filtered_imaging = imaging.take(rows)
+    filtered_imaging['acquisition_week'] = date_index['acquisition_week'][rows]
+    return filtered_imaging
+
+derived_table('qc_keys', 'source_qc', empty=dict)(get_qc_keys)
+
+@derived_table('qc', 'source_qc', 'qc_keys', 'imaging', 'start_date', 'end_date')
+def get_filtered_qc(qc, qc_keys, imaging, start_date, end_date):
+    if start_date is None and end_date is None:
+        # The report without dates shows all the qc ratings
+        return qc
+    return filter_qc(qc, imaging, qc_keys)
+derived_table('sites', 'imaging', empty=list)(lambda imaging: list(imaging.site.unique()))
+derived_table('imaging_overview', 'date_index', 'date_window')(get_window_overview)
+derived_table('indicated_received', 'imaging', 'reference_date')(
+    lambda imaging, reference_date: get_indicated_received(imaging, reference_date = reference_date))
+derived_table('ratings', 'indicated_received', 'qc')(get_ratings)
+derived_table('rating_counts', 'ratings')(get_rating_counts)
+
+@derived_table('no_bids', 'indicated_received')
+def get_no_bids(indicated_received):
+    index_cols = ['Site','Subject','Visit']
+    return indicated_received[indicated_received['BIDS']==0].sort_values(by=index_cols+['Scan'])
+
+@derived_table('mismatch', 'indicated_received')
+def get_mismatch(indicated_received):
+    df = indicated_received
+    return df[(df['DICOM']==1) & (df['Indicated'] != df['Received'])]
+
+# Heat matrices of all sites, built in one pass
+derived_table('heat_matrices', 'qc', empty=dict)(lambda qc: get_heat_matrices(qc, color_mapping_list))
+
+derived_table('heat_strips', 'qc', 'imaging', empty=dict)(
+    lambda qc, imaging: get_heat_strips(qc, imaging, color_mapping_list))
+
+@derived_table('heat_matrix', 'heat_matrices')
+def get_site_heat_matrix(heat_matrices, site):
+    return heat_matrices.get(site, pd.DataFrame())
+
+def warm_table_set(table_set, tables, workers=DATA_WARM_WORKERS):
+    '''Compute the listed tables of the table set in a thread pool and wait for them. tables is a list
+    of (name, *params) tuples.'''
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(get_table, table_set, *table) for table in tables]
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            print(e)
+    print('Process {} computed {} report tables in {:.2f}s'.format(os.getpid(), len(tables), time.perf_counter() - start))
+
+# Tables computed with every published snapshot, before any page asks for them (see warm_table_set)
+snapshot_warm_tables = [('imaging_overview',)]
+
+# Date filtered table sets
+_filtered_tables = make_lru_cache(FILTERED_DATA_CACHE_MB * 2**20, FILTERED_DATA_CACHE_SIZE)
+
+def get_filtered_store(snapshot, start_date=None, end_date=None):
+    '''Return the filtered_data store contents for the snapshot and filter dates (ISO date strings)'''
+    return {'version': snapshot['version'], 'start_date': start_date, 'end_date': end_date}
+
+def get_store_tables(store, url_data_path, local_data_path, source):
+    '''Return the table set for the filtered_data store. Tables are built from the snapshot of the
+    store's version, so a page opened before a refresh keeps its data (see get_data_snapshot).'''
+    snapshot = get_data_snapshot(url_data_path, local_data_path, source, store.get('version') if store else None)
+    start_date = store.get('start_date') if store else None
+    end_date = store.get('end_date') if store else None
+    if not start_date and not end_date:
+        return snapshot['tables']
+
+    key = (snapshot['version'], start_date, end_date, date.today())
+    table_set = lru_get(_filtered_tables, key)
+    if table_set is None:
+        table_set = make_table_set(snapshot['imaging'], snapshot['qc'],
+                                   start_date = pd.Timestamp(start_date) if start_date else None,
+                                   end_date = pd.Timestamp(end_date) if end_date else None)
+        for name in shared_tables:
+            table_set['tables'][name] = get_table(snapshot['tables'], name)
+        table_set.update(cache=_filtered_tables, cache_key=key)
+        lru_put(_filtered_tables, key, table_set)
+    return table_set
+
+if __name__ == '__main__':
+    # Ingest stage: convert the bundled csv files to the binary format so the app never parses them
+    for csv_path in ingest_data_files():
+        print('Ingested ' + csv_path)
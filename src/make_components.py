@@ -44,7 +44,7 @@ def make_pie_chart(pie_df, facet_col='Scan', facet_row=None):
 def bar_chart_dataframe(df, mcc_dict, count_col, x_col, color_col = None, facet_col = None, facet_row = None, chart_type='Count'):
     # Get grouping cols for stacked bar
     if x_col is None:
-        df['all'] = 1
+        df = df.assign(all=1)
         x_col ='all'
     bar_cols = [x_col]
     for col in [facet_col, facet_row]:
@@ -56,8 +56,29 @@ def bar_chart_dataframe(df, mcc_dict, count_col, x_col, color_col = None, facet_
     if color_col:
         group_cols.append(color_col)
     df = df.merge(pd.DataFrame(mcc_dict), how='left', on='site')
-    df = df[[count_col] + group_cols].groupby(group_cols).count().reset_index()
-    df['N'] = df[[count_col] + bar_cols].groupby(bar_cols)[count_col].transform('sum')
+    df = df[[count_col] + group_cols].groupby(group_cols, observed=True).count().reset_index()
+    return bar_chart_figure(df, count_col, x_col, color_col, facet_col, facet_row, bar_cols, chart_type)
+
+def bar_chart_cube(cube, count_col, x_col, color_col = None, facet_col = None, facet_row = None, chart_type='Count'):
+    ''' Same chart as bar_chart_dataframe, built by summing the count_col counts of a count cube
+    (see get_count_cube) instead of counting the rows of the data'''
+    if x_col is None:
+        cube = cube.assign(all=1)
+        x_col ='all'
+    bar_cols = [x_col]
+    for col in [facet_col, facet_row]:
+        if col:
+            bar_cols.append(col)
+
+    group_cols = bar_cols.copy()
+    if color_col:
+        group_cols.append(color_col)
+    df = cube.groupby(group_cols, observed=True)[count_col].sum().reset_index()
+    return bar_chart_figure(df, count_col, x_col, color_col, facet_col, facet_row, bar_cols, chart_type)
+
+def bar_chart_figure(df, count_col, x_col, color_col, facet_col, facet_row, bar_cols, chart_type='Count'):
+    ''' Build the stacked bar chart from the counts in df, grouped by bar_cols and color_col'''
+    df['N'] = df[[count_col] + bar_cols].groupby(bar_cols, observed=True)[count_col].transform('sum')
     df['Percent'] = 100 * df[count_col] / df['N']
 
     col_rename_dict = {'site':'Site', 'mcc':'MCC', 'rating': 'Image Rating',
@@ -131,11 +152,14 @@ def datatable_settings_multiindex(df, flatten_char = '_'):
 
 def generate_heat_matrix(df, colors):
     cut = len(df)
+    # Fix the color range so every page of a heat matrix maps ratings to the same colors
     fig = px.imshow(
             df.T,
             # height=cut*55,
             color_continuous_scale = colors,
-            contrast_rescaling =  'infer'
+            contrast_rescaling =  'infer',
+            zmin = 0,
+            zmax = 1,
     )
     fig.update_layout(
         coloraxis_showscale=False,
@@ -154,3 +178,29 @@ def generate_heat_matrix(df, colors):
         ygap = 3
     )
     return fig
+
+def generate_heat_strip(df, colors):
+    '''Compact heatmap of the mean ratings of each scan (rows) by acquisition week (columns)'''
+    fig = px.imshow(
+            df,
+            color_continuous_scale = colors,
+            zmin = 0,
+            zmax = 1,
+            aspect = 'auto',
+    )
+    fig.update_layout(
+        coloraxis_showscale=False,
+        margin=dict(t=0, b=0, l=0, r=0),
+        height=250,
+        xaxis_tickangle=-45
+    ).update_xaxes(
+        automargin=True,
+    ).update_yaxes(
+        automargin=True,
+    )
+    fig.update_traces(
+        xgap = 1,
+        ygap = 1,
+        hovertemplate = 'Week: %{x}<br>Scan: %{y}<br>Mean rating: %{z:.2f}<extra></extra>'
+    )
+    return fig